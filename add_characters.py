@@ -1,9 +1,27 @@
 #!/usr/bin/env python
+"""Import characters from a TSV file (columns id..., name, image_url, series, rarity, batch) into the catalog.
+
+The file is read twice, streaming: first every row is validated, then the characters are upserted in transactions
+of at most --chunk-size rows, so that even catalogs with millions of characters are imported in constant memory
+without holding the database's write lock for long. Only new and changed characters are written.
+An interrupted import can simply be run again. With --check-images the image urls which haven't been checked
+recently are checked afterwards (see utils.image_check).
+
+Usage: ./add_characters.py characters.tsv [--dry-run] [--chunk-size N] [--db path] [--check-images]
+"""
+import argparse
+import asyncio
 import csv
-import sys
-from typing import NamedTuple
+import json
+import sqlite3
+from collections import Counter
+from typing import NamedTuple, Iterator
 
+from data.CONSTANTS import DB_PATH, HTTP_LIMIT_PER_HOST, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, \
+    IMAGE_CHECK_CONCURRENCY, IMAGE_CHECK_MAX_AGE
 from utils import database
+from utils.http import HttpClient
+from utils.image_check import check_catalog_images
 
 
 Char = NamedTuple('Char', id=int, name=str, image_url=str, series=str, rarity=int, batch=str)
@@ -11,32 +29,130 @@ CHAR_ATTR_ORDER = 'id, name, image_url, series, rarity, batch'
 def throw(): raise ValueError
 
 
-if __name__ == '__main__':
-    with open(sys.argv[1], newline='') as tsvfile:
-        raw_char_rows = list(csv.DictReader(tsvfile, delimiter='\t'))
-
-    # Figure out which column contains the ids
-    id_key_candidates = [k for k in raw_char_rows[0].keys() if k.startswith('id')]
-    if len(id_key_candidates) > 1:
-        raise ValueError('Multiple columns could be the id!')
-    if len(id_key_candidates) == 0:
-        raise ValueError('No column looks like it contains the ids (none of them start with "id")!')
-    id_key = id_key_candidates[0]
-
-    # Sanitize the raw data into proper data types and check its validity
-    chars = []
-    for row in raw_char_rows:
+# the row value comparison is IS NOT rather than != because image_url may be NULL
+UPSERT = f"""
+INSERT INTO character({CHAR_ATTR_ORDER}) VALUES(?,?,?,?,?,?)
+ON CONFLICT(id) DO UPDATE SET
+    name=excluded.name, image_url=excluded.image_url, series=excluded.series, rarity=excluded.rarity,
+    batch=excluded.batch
+WHERE (name, image_url, series, rarity, batch)
+    IS NOT (excluded.name, excluded.image_url, excluded.series, excluded.rarity, excluded.batch)
+"""
+
+
+def read_chars(path: str) -> Iterator[Char]:
+    with open(path, newline='') as tsvfile:
+        reader = csv.DictReader(tsvfile, delimiter='\t')
+
+        # Figure out which column contains the ids
+        id_key_candidates = [k for k in reader.fieldnames or () if k.startswith('id')]
+        if len(id_key_candidates) > 1:
+            raise ValueError('Multiple columns could be the id!')
+        if len(id_key_candidates) == 0:
+            raise ValueError('No column looks like it contains the ids (none of them start with "id")!')
+        id_key = id_key_candidates[0]
+
+        # Sanitize the raw data into proper data types and check its validity
+        for row in reader:
+            try:
+                yield Char(id=int(row[id_key].strip()),
+                           name=row['name'].strip() or throw(),
+                           image_url=row['image_url'].strip() or None,
+                           series=row['series'].strip() or throw(),
+                           rarity=int(row['rarity'].strip()),
+                           batch=row['batch'].strip() or throw())
+            except Exception as e:
+                raise ValueError(f'ERRONEOUS ENTRY (line {reader.line_num}): {row}') from e
+
+
+def validate(db: sqlite3.Connection, chars: Iterator[Char]) -> int:
+    """Count the characters, raising a ValueError if an id appears twice.
+    The ids seen so far are kept in a temporary table, which SQLite spills to disk, rather than in memory."""
+    db.execute('BEGIN')
+    try:
+        db.execute('CREATE TEMP TABLE import_id(id INTEGER PRIMARY KEY)')
+        rows = 0
+        for char in chars:
+            try:
+                db.execute('INSERT INTO import_id(id) VALUES(?)', [char.id])
+            except sqlite3.IntegrityError:
+                raise ValueError(f'DUPLICATE ID: {char.id} ({char.name})') from None
+            rows += 1
+        return rows
+    finally:
+        # also drops the table, it was created in this transaction
+        db.execute('ROLLBACK')
+
+
+def chunks(chars: Iterator[Char], size: int) -> Iterator[list[Char]]:
+    chunk = []
+    for char in chars:
+        chunk.append(char)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_chunk(db: sqlite3.Connection, chunk: list[Char]) -> Counter:
+    """Upsert the characters (inside a transaction), counting the inserted, updated and unchanged ones"""
+    ids = {c.id for c in chunk}
+    existing = db.execute('SELECT COUNT(*) FROM character WHERE id IN (SELECT value FROM json_each(?))',
+                          [json.dumps(list(ids))]).fetchone()[0]
+    db.executemany('INSERT OR IGNORE INTO batch(name) VALUES(?)', [(batch,) for batch in {c.batch for c in chunk}])
+    # characters which already existed but didn't change aren't touched at all, so they aren't counted in rowcount
+    changed = db.executemany(UPSERT, chunk).rowcount
+    inserted = len(ids) - existing
+    return Counter(inserted=inserted, updated=changed - inserted, unchanged=len(chunk) - changed)
+
+
+def import_chars(db: sqlite3.Connection, chars: Iterator[Char], chunk_size: int, dry_run: bool) -> Counter:
+    counts = Counter()
+    for chunk in chunks(chars, chunk_size):
+        db.execute('BEGIN IMMEDIATE')
         try:
-            chars.append(Char(id=int(row[id_key].strip()),
-                              name=row['name'].strip() or throw(),
-                              image_url=row['image_url'].strip() or None,
-                              series=row['series'].strip() or throw(),
-                              rarity=int(row['rarity'].strip()),
-                              batch=row['batch'].strip() or throw()))
-        except Exception as e:
-            raise ValueError(f'ERRONEOUS ENTRY: {row}') from e
-
-    # Insert Data
-    with database.connect() as db:
-        db.executemany(f'REPLACE INTO character({CHAR_ATTR_ORDER}) VALUES(?,?,?,?,?,?)', chars)
-        db.executemany('INSERT OR IGNORE INTO batch(name) VALUES(?)', {(c.batch,) for c in chars})
+            counts += upsert_chunk(db, chunk)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('ROLLBACK' if dry_run else 'COMMIT')
+    return counts
+
+
+async def check_images(db_path):
+    db = database.Database(db_path)
+    client = HttpClient(limit_per_host=HTTP_LIMIT_PER_HOST, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES,
+                        backoff=HTTP_BACKOFF)
+    try:
+        return await check_catalog_images(db, client, IMAGE_CHECK_MAX_AGE, IMAGE_CHECK_CONCURRENCY)
+    finally:
+        await client.close()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--db', default=DB_PATH, help='database to import into')
+    parser.add_argument('--dry-run', action='store_true', help="count what would change, but don't change it")
+    parser.add_argument('--chunk-size', type=int, default=10_000, help='characters upserted per transaction')
+    parser.add_argument('--check-images', action='store_true', help='check the image urls after importing')
+    args = parser.parse_args()
+
+    db = database.connect(args.db)
+    db.isolation_level = None
+    # validate everything before writing anything
+    rows = validate(db, read_chars(args.path))
+    counts = import_chars(db, read_chars(args.path), args.chunk_size, args.dry_run)
+    db.close()
+    print(f"{'would have imported' if args.dry_run else 'imported'} {rows} characters:"
+          f" {counts['inserted']} new, {counts['updated']} updated, {counts['unchanged']} unchanged")
+
+    if args.check_images and not args.dry_run:
+        image_counts = asyncio.run(check_images(args.db))
+        print(f"checked {image_counts['ok'] + image_counts['dead']} images, {image_counts['dead']} of them are dead")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import asyncio
+import weakref
+from functools import partial
+from typing import Any, Awaitable, Callable, Collection, Mapping, Optional
+
+import nextcord
+from nextcord.ext import commands
+
+
+class ButtonMenu(nextcord.ui.View):
+    """Menu of buttons, one per entry of an {emoji: callback} mapping.
+
+    Callbacks are called with emoji= and user= and the first one that returns something other than None closes the
+    menu. The buttons are sent along with the message (pass the menu as view=).
+    """
+
+    # menus still waiting for clicks, weak so that a menu whose message was never sent doesn't stay open forever
+    open_menus: 'weakref.WeakSet[ButtonMenu]' = weakref.WeakSet()
+
+    def __init__(self, ctx: commands.Context, buttons: Mapping[str, Callable[..., Awaitable]],
+                 *, users: Collection[nextcord.User] = (), timeout: float = 300):
+        super().__init__(timeout=timeout)
+        self.ctx = ctx
+        self.user_ids = {u.id for u in users or [ctx.author]}
+        self.result = None
+        # callbacks are run one at a time
+        self._lock = asyncio.Lock()
+        for emoji, callback in buttons.items():
+            button = nextcord.ui.Button(emoji=emoji)
+            button.callback = partial(self._click, emoji, callback)
+            self.add_item(button)
+        ButtonMenu.open_menus.add(self)
+
+    async def interaction_check(self, interaction: nextcord.Interaction) -> bool:
+        if interaction.user.id in self.user_ids:
+            return True
+        await interaction.response.send_message("These buttons aren't meant for you!", ephemeral=True)
+        return False
+
+    async def _click(self, emoji: str, callback: Callable[..., Awaitable], interaction: nextcord.Interaction):
+        # acknowledge right away, callbacks might wait for answers for much longer than discord does
+        await interaction.response.defer()
+        async with self._lock:
+            if self.is_finished():
+                return
+            ret = await callback(emoji=emoji, user=interaction.user)
+        if ret is not None:
+            self.result = ret
+            self.stop()
+
+    def stop(self):
+        ButtonMenu.open_menus.discard(self)
+        super().stop()
+
+    async def on_timeout(self):
+        ButtonMenu.open_menus.discard(self)
+
+    async def on_error(self, error: Exception, item: nextcord.ui.Item, interaction: nextcord.Interaction):
+        # report errors of callbacks like errors of the command they belong to
+        await self.ctx.bot.on_command_error(self.ctx, error)
+
+    async def run(self, msg: nextcord.Message) -> Optional[Any]:
+        """Wait until a callback closed the menu or until it timed out, then remove the buttons from msg"""
+        await self.wait()
+        try:
+            await msg.edit(view=None)
+        except (nextcord.Forbidden, nextcord.NotFound):
+            pass
+        return self.result
@@ -5,20 +5,23 @@ import nextcord
 from nextcord import Color
 from nextcord.ext import commands
 
-from api.expected_errors import ExpectedCommandError
+from api.button_menu import ButtonMenu
 from data.CONSTANTS import NO, YES, PRINTER, DOWN, UP
 from utils.formatting import paginate
 
+# page number -> (page content, whether there is a next page)
+PageProvider = Callable[[int], Awaitable[tuple[str, bool]]]
+
 
 class Context(commands.Context):
     async def send_embed(self, color: Union[Color, int], description: Optional[str] = None,
-                         content: Optional[str] = None, **kwargs):
+                         content: Optional[str] = None, view: Optional[nextcord.ui.View] = None, **kwargs):
         kwargs.setdefault('description', description)
         if len(kwargs.get('title', ())) > 256:
             raise ValueError('Title must be 256 or fewer in length')
         if len(kwargs.get('description', ())) > 2048:
             raise ValueError('Description must be 2048 or fewer in length')
-        return await self.send(content, embed=nextcord.Embed(color=color, **kwargs))
+        return await self.send(content, embed=nextcord.Embed(color=color, **kwargs), view=view)
 
     async def info(self, description: Optional[str] = None, content: Optional[str] = None, **kwargs):
         return await self.send_embed(nextcord.Color.green(), description, content, **kwargs)
@@ -29,92 +32,93 @@ class Context(commands.Context):
     async def error(self, description: Optional[str] = None, content: Optional[str] = None, **kwargs):
         return await self.send_embed(nextcord.Color.red(), description, content, **kwargs)
 
-    async def confirm(self, msg: nextcord.Message, users: set[nextcord.User] = None, **kwargs) -> bool:
-        users = users or set()
-
-        async def yes(reaction: nextcord.Reaction, **_):
-            if users.issubset(await reaction.users().flatten()):
+    def button_menu(self, buttons: Mapping[str, Callable[..., Awaitable]],
+                    *, users: Collection[nextcord.User] = (), timeout: int = 300) -> ButtonMenu:
+        """Buttons calling {emoji: callback} callbacks, send them with a message (view=) and then run them:
+            menu = ctx.button_menu({...})
+            await menu.run(await ctx.send(..., view=menu))
+        """
+        return ButtonMenu(self, buttons, users=users, timeout=timeout)
+
+    def confirm_buttons(self, users: set[nextcord.User] = None, *, timeout: int = 300) -> ButtonMenu:
+        """Running the menu returns True once all users (the author by default) accepted and False if one of them
+        declined, None if it timed out."""
+        required = {u.id for u in users} if users else {self.author.id}
+        accepted = set()
+
+        async def yes(user: nextcord.User, **_):
+            accepted.add(user.id)
+            if accepted >= required:
                 return True
 
         async def no(**_):
             return False
 
-        return bool(await self.reaction_buttons(msg, {YES: yes, NO: no}, users=users, **kwargs))
+        return self.button_menu({YES: yes, NO: no}, users=users, timeout=timeout)
+
+    async def confirm(self, msg: nextcord.Message, users: set[nextcord.User] = None, *, timeout: int = 300) -> bool:
+        """Compatibility wrapper of confirm_buttons for messages that were sent already, the buttons are added to msg.
+        New code should send the menu along with the message instead."""
+        menu = self.confirm_buttons(users, timeout=timeout)
+        await msg.edit(view=menu)
+        return bool(await menu.run(msg))
 
     async def reaction_buttons(self, msg: nextcord.Message,
                                reactions: Mapping[str, Callable[..., Awaitable]],
                                *, users: Collection[nextcord.User] = (), timeout: int = 300):
-        users = users or [self.author]
-        for r in reactions:
-            await msg.add_reaction(r)
-
-        def any_user_answered(reaction: nextcord.Reaction, user: nextcord.User) -> bool:
-            return (reaction.message.id == msg.id
-                    and user in users
-                    and str(reaction.emoji) in reactions)
-
-        try:
-            while True:
-                try:
-                    reaction, user = await self.bot.wait_for('reaction_add', timeout=timeout, check=any_user_answered)
-                except asyncio.TimeoutError:
-                    break
-
-                if callback := reactions.get(reaction.emoji):
-                    try:
-                        ret = await callback(reaction=reaction, user=user)
-
-                    except ExpectedCommandError as e:
-                        # Handle the exception but continue waiting for more reactions
-                        await self.bot.on_command_error(self, e)
-                        continue
-
-                    finally:
-                        # Remove the user's reaction if possible in case they want to click it again
-                        try:
-                            await reaction.remove(user)
-                        except (nextcord.Forbidden, nextcord.NotFound):
-                            pass
-
-                    if ret is not None:
-                        return ret
-
-        finally:
-            try:
-                # Clear the reactions since clicking them no longer does anything
-                await msg.clear_reactions()
-            except (nextcord.Forbidden, nextcord.NotFound):
-                pass
+        """Compatibility wrapper of button_menu for messages that were sent already, the buttons are added to msg.
+        New code should send the menu along with the message instead."""
+        menu = self.button_menu(reactions, users=users, timeout=timeout)
+        await msg.edit(view=menu)
+        return await menu.run(msg)
 
     async def send_paginated(self, content: str, prefix: str = '', suffix: str = '', **kwargs):
         pages = list(paginate(content, prefix=prefix, suffix=suffix))
         await self.send_pager(pages, **kwargs)
 
-    async def send_pager(self, pages: Sequence[str], *, users: Collection[nextcord.User] = (), timeout: int = 600):
+    async def send_pager(self, pages: Sequence[str], **kwargs):
+        async def page(number: int) -> tuple[str, bool]:
+            return pages[number], number + 1 < len(pages)
+
+        await self.send_lazy_pager(page, **kwargs)
+
+    async def send_lazy_pager(self, page: PageProvider, *, users: Collection[nextcord.User] = (),
+                              timeout: int = 600):
+        """Like send_pager, but pages are only fetched and rendered once they are viewed.
+        page(number) returns the content of the page and whether there is a page after it."""
         i = 0
-        msg = await self.send(pages[i])
+        content, has_next = await page(i)
 
-        if len(pages) == 1:
+        if not has_next:
+            await self.send(content)
             return
 
         async def update_page(new_number: int):
-            nonlocal i
+            nonlocal i, has_next
+            if new_number == i:
+                return
+            content_, has_next = await page(new_number)
             i = new_number
-            await msg.edit(content=pages[i])
+            await msg.edit(content=content_)
 
         async def printer(**_):
             await msg.delete()
-            for p in pages:
-                await self.send(p)
+            number, more = 0, True
+            while more:
+                content_, more = await page(number)
+                await self.send(content_)
+                number += 1
+            return True
 
         async def up(**_):
             await update_page(max(i - 1, 0))
 
         async def down(**_):
-            await update_page(min(i + 1, len(pages) - 1))
+            await update_page(i + 1 if has_next else i)
 
-        await self.reaction_buttons(msg, users=users, timeout=timeout,
-                                    reactions={UP: up, DOWN: down, PRINTER: printer})
+        menu = self.button_menu({UP: up, DOWN: down, PRINTER: printer}, users=users, timeout=timeout)
+        msg = await self.send(content, view=menu)
+        await menu.run(msg)
 
     async def quick_question(self, question: str, user: Optional[nextcord.User] = None, delete_answer: bool = True
                              ) -> Optional[str]:
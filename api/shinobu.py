@@ -1,36 +1,138 @@
+import asyncio
+import json
 import logging
 import os
 import re
+import time
 import traceback
+from collections import Counter
+from typing import Optional
 
 import nextcord
 from nextcord.ext import commands
 
+from api.button_menu import ButtonMenu
 from api.expected_errors import ExpectedCommandError
 from api.my_context import Context
-from utils import database
+from data.CONSTANTS import MAL_METADATA_TTL, MAL_METADATA_MAX_STALENESS, MAL_SEARCH_TTL, MAL_SEARCH_NEGATIVE_TTL, \
+    HTTP_LIMIT_PER_HOST, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF
+from utils import database, migrations
+from utils.catalog_search import CATALOG_INDEX
+from utils.database import DB
+from utils.http import HttpClient
+from utils.mal_cache import MalMetadataCache, MalSearchCache
+from utils.mal_scraper import RATE_LIMITER
+from utils.mal_titles import MAL_TITLE_INDEX
+from utils.metrics import METRICS, COMMAND_SECONDS, DISCORD_SECONDS
+from utils.scheduler import Scheduler
 
 logger = logging.getLogger(__name__)
 
 
+def existing_user_ids(db: DB, ids: list[int]) -> set[int]:
+    return {row[0] for row in db.execute('SELECT id FROM user WHERE id IN (SELECT value FROM json_each(?))',
+                                         [json.dumps(ids)])}
+
+
 class Shinobu(commands.Bot):
 
     EXTENSION_MODULES = ['extensions.' + ext for ext in """
-        call_notification economy misc myanimelist shop trade
+        call_notification catalog economy misc myanimelist shop stats trade
     """.split()]
 
+    # members diffed (and users inserted) at once by update_user_database
+    USER_SYNC_CHUNK = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db = database.Database()
+        # every outgoing request but Discord's
+        self.http_client = HttpClient(limit_per_host=HTTP_LIMIT_PER_HOST, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES,
+                                      backoff=HTTP_BACKOFF, rate_limiter=RATE_LIMITER)
+        self.mal_cache = MalMetadataCache(self.db, self.http_client, ttl=MAL_METADATA_TTL,
+                                          max_staleness=MAL_METADATA_MAX_STALENESS)
+        self.mal_search_cache = MalSearchCache(self.db, ttl=MAL_SEARCH_TTL, negative_ttl=MAL_SEARCH_NEGATIVE_TTL)
+        self.scheduler = Scheduler(self.db)
+        # number of user sync events and rows they touched, per event type
+        self.user_sync_events: Counter[str] = Counter()
+        self.user_sync_rows: Counter[str] = Counter()
+        self._instrument_http()
+        METRICS.collect('shinobu_open_menus', 'Button menus waiting for clicks', lambda: len(ButtonMenu.open_menus))
+        METRICS.collect('shinobu_user_sync_events_total', 'User syncs, by event',
+                        lambda: self.user_sync_events, label='event', type_='counter')
+        METRICS.collect('shinobu_user_sync_rows_total', 'User rows inserted by user syncs, by event',
+                        lambda: self.user_sync_rows, label='event', type_='counter')
+        METRICS.collect('shinobu_mal_search_cache_total', 'MAL search cache lookups, by result',
+                        lambda: self.mal_search_cache.stats, label='result', type_='counter')
+        METRICS.collect('shinobu_mal_title_index_total', 'Searches answered by the local MAL title index, by result',
+                        lambda: MAL_TITLE_INDEX.stats, label='result', type_='counter')
+        METRICS.collect('shinobu_http_connections_total', 'Connections used by outgoing requests, created or reused',
+                        lambda: self.http_client.connections, label='result', type_='counter')
+        METRICS.collect('shinobu_http_requests_total', 'Outgoing requests, sent, retried or coalesced with another',
+                        lambda: self.http_client.requests, label='result', type_='counter')
+
+    def _instrument_http(self):
+        # nextcord has no hooks for its REST calls, so the single method they all go through is wrapped
+        request = self.http.request
+
+        async def timed_request(route, **kwargs):
+            with DISCORD_SECONDS.time(method=route.method, route=route.path):
+                return await request(route, **kwargs)
+
+        self.http.request = timed_request
+
     async def on_ready(self):
-        self.update_user_database()
+        await self.db.transaction(migrations.migrate)
+        await self.db.read(CATALOG_INDEX.catalog)
+        await self.update_user_database()
         self.reload_all_extensions()
+        # on_ready runs again after every reconnect, the scheduler is only started once
+        self.scheduler.start()
         logger.info(f'Logged on as {self.user}!')
 
-    async def on_member_join(self, _: nextcord.Member):
-        self.update_user_database()
+    async def invoke(self, ctx: Context):
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                COMMAND_SECONDS.observe(time.perf_counter() - start, command=ctx.command.qualified_name,
+                                        outcome='error' if ctx.command_failed else 'ok')
+
+    async def on_member_join(self, member: nextcord.Member):
+        rows = await self.db.execute('INSERT OR IGNORE INTO user(id) VALUES(?)', [member.id])
+        self._count_user_sync('member_join', rows)
+
+    async def on_guild_join(self, guild: nextcord.Guild):
+        await self.update_user_database([guild], event='guild_join')
+
+    async def update_user_database(self, guilds: Optional[list[nextcord.Guild]] = None, event: str = 'startup'):
+        """Insert the members of the guilds (all of them by default) that aren't users yet.
+        Members are diffed against the existing users in chunks, yielding to the event loop in between.
+        Users are never removed (leaving members and guilds touch no rows): their balance and waifus survive a rejoin.
+        """
+        rows = 0
+        for guild in self.guilds if guilds is None else guilds:
+            # guild.members builds a new list on every access
+            members = guild.members
+            for i in range(0, len(members), self.USER_SYNC_CHUNK):
+                ids = [member.id for member in members[i:i + self.USER_SYNC_CHUNK]]
+                known_ids = await self.db.read(existing_user_ids, ids)
+                if new_ids := [[id_] for id_ in dict.fromkeys(ids) if id_ not in known_ids]:
+                    rows += await self.db.executemany('INSERT OR IGNORE INTO user(id) VALUES(?)', new_ids)
+                await asyncio.sleep(0)
+        self._count_user_sync(event, rows)
+
+    def _count_user_sync(self, event: str, rows: int):
+        self.user_sync_events[event] += 1
+        self.user_sync_rows[event] += rows
+        logger.debug(f'user sync ({event}): {rows} rows touched')
 
-    def update_user_database(self):
-        with database.connect() as db:
-            db.executemany('INSERT OR IGNORE INTO user(id) VALUES(?)',
-                           [[m.id] for g in self.guilds for m in g.members])
+    async def close(self):
+        self.scheduler.stop()
+        await super().close()
+        await self.http_client.close()
+        self.db.close()
 
     def reload_all_extensions(self):
         for ext in self.EXTENSION_MODULES:
@@ -0,0 +1,58 @@
+"""Check which users the birthday job celebrates.
+
+Users with unset ('' or NULL) or malformed birthdays must never get a present, birthdays that passed while the bot
+was offline get one (once) and are moved to the next year, future ones are left alone.
+
+Usage: python -m benchmarks.birthdays
+"""
+import sqlite3
+import sys
+from datetime import date
+
+from extensions.economy import BIRTHDAY_USERS_QUERY, give_birthday_present
+from utils.database import User
+from utils.migrations import migrate
+
+TODAY = date(2024, 6, 15)
+# user id -> (birthday, whether it is celebrated, birthday afterwards)
+USERS = {
+    1: (None, False, None),
+    2: ('', False, ''),
+    3: ('06-15', False, '06-15'),
+    4: ('2024-06-15', True, '2025-06-15'),
+    5: ('2021-03-01', True, '2025-03-01'),
+    6: ('2024-12-24', False, '2024-12-24'),
+}
+
+
+def main():
+    db = sqlite3.connect(':memory:', isolation_level=None)
+    db.row_factory = sqlite3.Row
+    migrate(db)
+    db.executemany('INSERT INTO user(id, birthday) VALUES(?, ?)', [(id_, b) for id_, (b, _, _) in USERS.items()])
+
+    errors = []
+    # twice: a present is only given once per birthday
+    for _ in range(2):
+        for user in User.select_many(db, BIRTHDAY_USERS_QUERY, [TODAY.isoformat()]):
+            if not USERS[user.id][1]:
+                errors.append(f'user {user.id} with the birthday {user.birthday!r} was celebrated')
+            give_birthday_present(db, user, TODAY)
+
+    for id_, (birthday, celebrated, after) in USERS.items():
+        balance, stored = db.execute('SELECT balance, birthday FROM user WHERE id=?', [id_]).fetchone()
+        if balance != (100 if celebrated else 0):
+            errors.append(f'user {id_} with the birthday {birthday!r} got {balance} instead of'
+                          f' {100 if celebrated else 0}')
+        if stored != after:
+            errors.append(f'the birthday {birthday!r} of user {id_} became {stored!r} instead of {after!r}')
+
+    for error in errors:
+        print(f'ERROR: {error}')
+    if errors:
+        sys.exit(1)
+    print(f'{len(USERS)} birthdays celebrated as expected')
+
+
+if __name__ == '__main__':
+    main()
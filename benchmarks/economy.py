@@ -0,0 +1,157 @@
+"""Time the hot paths of the waifu economy on a synthetic database.
+
+Prints a table and writes the results as JSON (with the commit they were measured at) so that runs on different
+commits can be compared.
+
+Usage: python -m benchmarks.economy [--db path] [--json results.json] [synthetic data options, see
+benchmarks.synthetic]
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from benchmarks.synthetic import add_arguments, config_from_arguments, generate
+from utils import database
+from utils.database import Character, Rarity, User, Waifu
+from utils.formatting import paginate
+from utils.waifu_search import WAIFU_INDEX
+from utils.waifus import SAMPLERS, buy_pack, find_waifus, give_waifu, pick_character, pick_rarity, waifu_list_page
+
+
+def measure(func: Callable[[], object], min_time: float = .2, rounds: int = 5) -> dict:
+    """Time func over several rounds of enough calls to take min_time each, per call times in microseconds"""
+    calls = 1
+    while (elapsed := _time_calls(func, calls)) < min_time / rounds:
+        calls *= 2 if elapsed == 0 else max(2, int(min_time / rounds / elapsed))
+    times = [_time_calls(func, calls) / calls * 1e6 for _ in range(rounds)]
+    return {'calls': calls * rounds, 'median_us': statistics.median(times), 'min_us': min(times)}
+
+
+def _time_calls(func: Callable[[], object], calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return time.perf_counter() - start
+
+
+PAGE_SIZE = 20
+
+
+def rolled_back(db: sqlite3.Connection, func: Callable[[], object]) -> Callable[[], object]:
+    """Run func inside a transaction that is rolled back, so writing benchmarks don't change the data.
+    Its on_commit callbacks are dropped like Database.transaction drops them on a rollback, otherwise they would
+    add the rolled back waifus to the search index."""
+    def run():
+        db.execute('BEGIN')
+        database._commit_callbacks.callbacks = []
+        try:
+            func()
+        finally:
+            database._commit_callbacks.callbacks = None
+            db.execute('ROLLBACK')
+
+    return run
+
+
+def benchmarks(db: sqlite3.Connection) -> dict[str, Callable[[], object]]:
+    rng = random.Random(0)
+    pack = db.execute('SELECT name FROM pack LIMIT 1').fetchone()[0]
+    # the user with the biggest collection is the worst case for the per-user paths
+    user_id = db.execute('SELECT user FROM waifu GROUP BY user ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+    user = User.select_one(db, 'SELECT * FROM user WHERE id=?', [user_id])
+    names = [r[0] for r in db.execute('SELECT character.name FROM waifu JOIN character ON character.id = waifu.character'
+                                      ' WHERE waifu.user=?', [user_id])]
+    characters = db.execute('SELECT COUNT(*) FROM character').fetchone()[0]
+    rarity = Rarity.select_one(db, 'SELECT * FROM rarity WHERE value=1')
+
+    # the key of the last waifu before the last full page of the list
+    last_page_key = db.execute('SELECT rarity, name, id FROM waifu WHERE user = ?'
+                               ' ORDER BY rarity, name DESC, id DESC LIMIT 1 OFFSET ?',
+                               [user_id, PAGE_SIZE]).fetchone()
+    waifu_row = {'id': 1,
+                 'character.id': 1, 'character.name': 'Shinobu Oshino', 'character.image_url': None,
+                 'character.series': 'Monogatari',
+                 'rarity.value': 4, 'rarity.name': 'Legendary', 'rarity.colour': 0, 'rarity.refund': 200,
+                 'rarity.upgrade_cost': None, 'rarity.auto_upgrade': False,
+                 'user.id': 1, 'user.balance': 100, 'user.last_withdrawal': '2022-01-01 00:00:00',
+                 'user.birthday': None, 'user.mal_username': None}
+    text = '\n'.join(f'{name:<40} - Common' for name in names[:20_000])
+
+    def new_character() -> Character:
+        return Character.select_one(db, 'SELECT * FROM character WHERE id=?', [rng.randrange(characters)])
+
+    # warm the samplers and the search index, their cold builds are measured separately
+    pick_character(db, pack, rarity.value)
+    list(find_waifus(db, user_id, names[0]))
+
+    def cold_pick_character():
+        SAMPLERS.clear()
+        pick_character(db, pack, rarity.value)
+
+    def cold_find_waifus():
+        WAIFU_INDEX._indexes.pop(user_id, None)
+        list(find_waifus(db, user_id, rng.choice(names)))
+
+    return {
+        'pick_rarity': lambda: pick_rarity(db),
+        'pick_character': lambda: pick_character(db, pack, rarity.value),
+        'pick_character (cold sampler)': cold_pick_character,
+        'buy_pack': rolled_back(db, lambda: buy_pack(db, user_id, pack)),
+        'give_waifu': rolled_back(db, lambda: give_waifu(db, user, new_character(), rarity)),
+        'waifu_list_page (first page)': lambda: waifu_list_page(db, user_id, None, PAGE_SIZE + 1),
+        'waifu_list_page (last page)': lambda: waifu_list_page(db, user_id, tuple(last_page_key), PAGE_SIZE + 1),
+        'find_waifus': lambda: list(find_waifus(db, user_id, rng.choice(names))),
+        'find_waifus (cold index)': cold_find_waifus,
+        'RowData.build': lambda: Waifu.build(**waifu_row),
+        'paginate': lambda: list(paginate(text, prefix='```md\n', suffix='```')),
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='existing database to use instead of generating one')
+    parser.add_argument('--json', help='file to write the results to')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    config = None
+    if args.db:
+        db = sqlite3.connect(args.db, isolation_level=None)
+        db.row_factory = sqlite3.Row
+    else:
+        config = config_from_arguments(args)
+        start = time.perf_counter()
+        db = generate(Path(tempfile.mkdtemp()) / 'shinobu.db', config)
+        print(f'generated {config} in {time.perf_counter() - start:.1f}s')
+
+    results = {name: measure(func) for name, func in benchmarks(db).items()}
+    for name, result in results.items():
+        print(f'{name:<32} {result["median_us"]:12.1f} us/call (min {result["min_us"]:.1f}, {result["calls"]} calls)')
+
+    if args.json:
+        Path(args.json).write_text(json.dumps({
+            'commit': commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'config': config.as_dict() if config else {'db': args.db},
+            'results': results,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
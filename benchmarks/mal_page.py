@@ -0,0 +1,76 @@
+"""Check the myanimelist.net page parser against the pages in benchmarks/fixtures/mal and time it.
+
+The fixtures are synthetic pages, not recordings of myanimelist.net: they copy the markup the parser relies on (the
+og: meta tags, the score label, the Information sidebar, the alternative titles) and pad it with filler scripts and
+reviews to the size of a real page, see benchmarks/fixtures/mal/README.md.
+
+Every fixture is parsed and compared with benchmarks/fixtures/mal/expected.json, then the CPU time per page of the
+single pass parser is compared with the former one regex scan per field.
+
+Usage: python -m benchmarks.mal_page [rounds]
+"""
+import json
+import re
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from utils.mal_page import parse_series_page
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'mal'
+
+# the patterns the scraper used to run over the whole page, one findall each
+LEGACY_PATTERNS = {
+    'title': r'<span(?=.*itemprop="name").*>(.+?)</span>',
+    'score': r'<div(?=.*class="score-label).*>(\d\.\d\d)</div>',
+    'status': r'<span.*?>Status:</span>\s*(.+?)\s*<',
+    'duration': r'<span.*?>Duration:</span>\s*(?:(\d+) hr.)?\s*(?:(\d+) min.)?',
+    'volumes': r'<span.*?>Volumes:</span>\s*(.+?)\s',
+    'chapters': r'<span.*?>Chapters:</span>\s*(.+?)\s',
+}
+
+
+def legacy_parse(page: str):
+    title = re.findall(LEGACY_PATTERNS['title'], page)
+    for name, pattern in LEGACY_PATTERNS.items():
+        re.findall(pattern, page)
+    if title:
+        re.findall(rf'<img(?=.*alt="{title[0]}").*src="(.+?)".*>', page)
+
+
+def check(name: str, page: str, expected: dict) -> list[str]:
+    parsed = vars(parse_series_page(page, name))
+    if isinstance(parsed['duration'], timedelta):
+        parsed['duration'] = int(parsed['duration'].total_seconds())
+    parsed['alternative_titles'] = list(parsed['alternative_titles'])
+    return [f'{name}: {field} is {parsed[field]!r} instead of {value!r}'
+            for field, value in expected.items() if parsed[field] != value]
+
+
+def cpu_time_per_call(func, page: str, rounds: int) -> float:
+    start = time.process_time()
+    for _ in range(rounds):
+        func(page)
+    return (time.process_time() - start) / rounds
+
+
+def main(rounds: int = 20):
+    expected = json.loads((FIXTURES / 'expected.json').read_text())
+    errors = []
+    for name, fields in expected.items():
+        page = (FIXTURES / name).read_text()
+        errors += check(name, page, fields)
+        new = cpu_time_per_call(parse_series_page, page, rounds)
+        old = cpu_time_per_call(legacy_parse, page, rounds)
+        print(f'{name:<20} {len(page) / 1024:6.0f}KB  parse_series_page {new * 1e3:7.2f}ms'
+              f'  regex per field {old * 1e3:8.2f}ms  ({old / new:.1f}x)')
+
+    for error in errors:
+        print(f'ERROR: {error}')
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
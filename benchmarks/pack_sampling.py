@@ -0,0 +1,72 @@
+"""Compare the cached alias-table pack draws with the old per-draw SQL path.
+
+Usage: python -m benchmarks.pack_sampling [characters] [draws]
+"""
+import random
+import sqlite3
+import sys
+import timeit
+
+from utils.database import Character, Rarity
+from utils.migrations import migrate
+from utils.waifus import pick_from_pack, SAMPLERS
+
+PACK = 'Benchmark'
+
+
+def build_catalog(characters: int) -> sqlite3.Connection:
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    migrate(db)
+    db.executemany('INSERT INTO rarity VALUES(?,?,?,?,?,?,?)',
+                   [(1, 'Common', 0, 70, 5, 20, 1), (2, 'Rare', 0, 25, 15, 60, 1), (3, 'Epic', 0, 5, 50, None, 0)])
+    batches = [f'batch {i}' for i in range(100)]
+    db.execute('INSERT INTO pack VALUES(?, 10, ?, DATE(), NULL)', [PACK, PACK])
+    db.executemany('INSERT INTO batch VALUES(?)', [(b,) for b in batches])
+    db.executemany('INSERT INTO batch_in_pack VALUES(?,?,?)', [(b, PACK, random.randint(1, 5)) for b in batches])
+    db.executemany('INSERT INTO character VALUES(?,?,?,?,?,?)',
+                   [(i, f'Character {i}', None, f'Series {i % 5000}', random.choice((1, 1, 1, 2, 2, 3)),
+                     random.choice(batches)) for i in range(characters)])
+    db.commit()
+    return db
+
+
+def sql_pick_from_pack(db: sqlite3.Connection, pack_name: str) -> tuple[Character, Rarity]:
+    """The implementation of pick_from_pack before the samplers were cached."""
+    rarities = db.execute('SELECT * FROM rarity').fetchall()
+    rarity = Rarity.build(**random.choices(rarities, weights=[r['weight'] for r in rarities])[0])
+    chars = [dict(c) for c in db.execute("""
+    SELECT character.id,
+           character.name,
+           character.image_url,
+           character.series,
+           character.rarity AS 'rarity.value',
+           character.batch AS 'batch.name',
+           MAX(batch_in_pack.weight) AS __weight__
+    FROM character
+    JOIN batch_in_pack      ON batch_in_pack.batch = character.batch
+    JOIN rarity             ON rarity.value >= character.rarity
+    WHERE batch_in_pack.pack = ? AND rarity.value = ?
+    GROUP BY character.id
+    """, [pack_name, rarity.value])]
+    weights = [c.pop('__weight__') for c in chars]
+    return Character.build(**random.choices(chars, weights=weights)[0]), rarity
+
+
+def main(characters: int = 100_000, draws: int = 20):
+    db = build_catalog(characters)
+
+    sql = timeit.timeit(lambda: sql_pick_from_pack(db, PACK), number=draws) / draws
+    SAMPLERS.clear()
+    cold = timeit.timeit(lambda: pick_from_pack(db, PACK), number=1)
+    warm_draws = draws * 1000
+    warm = timeit.timeit(lambda: pick_from_pack(db, PACK), number=warm_draws) / warm_draws
+
+    print(f'catalog of {characters} characters')
+    print(f'sql path:         {sql * 1e3:10.3f} ms/draw')
+    print(f'alias (cold):     {cold * 1e3:10.3f} ms (builds one sampler)')
+    print(f'alias (warm):     {warm * 1e3:10.3f} ms/draw')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
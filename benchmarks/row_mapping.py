@@ -0,0 +1,106 @@
+"""Microbenchmarks for building row data from list_waifus-shaped rows.
+
+Compares the compiled row mappers with the old tree-building RowData.build and slotted row classes with
+regular (__dict__ based) ones.
+
+Usage: python -m benchmarks.row_mapping [rows]
+"""
+import dataclasses
+import sys
+import timeit
+import tracemalloc
+from collections import defaultdict
+from typing import Any
+
+from utils.database import Waifu, Character, Rarity, User, RowData
+
+COLUMNS = ('id',
+           'character.id', 'character.name', 'character.image_url', 'character.series',
+           'rarity.value', 'rarity.name', 'rarity.colour', 'rarity.refund', 'rarity.upgrade_cost',
+           'rarity.auto_upgrade',
+           'user.id', 'user.balance', 'user.last_withdrawal', 'user.birthday', 'user.mal_username')
+
+
+def make_rows(amount: int) -> list[tuple]:
+    return [(i,
+             i, f'Character {i}', f'https://example.com/{i}.png', f'Series {i % 100}',
+             i % 3 + 1, 'Rare', 0xffffff, 15, 60, True,
+             1, 100, '2022-01-01 00:00:00', '2000-01-01', 'someone')
+            for i in range(amount)]
+
+
+def unslotted(cls: type) -> type:
+    return dataclasses.make_dataclass(
+        cls.__name__,
+        [(f.name, f.type, dataclasses.field(default=f.default)) for f in dataclasses.fields(cls)],
+        unsafe_hash=True)
+
+
+LEGACY_CLASSES = {cls.__name__: unslotted(cls) for cls in (Waifu, Character, Rarity, User)}
+
+
+def nested_dict() -> defaultdict:
+    return defaultdict(nested_dict)
+
+
+def legacy_from_tree(cls: type, tree: dict[str, Any]):
+    for key, value in tree.copy().items():
+        if isinstance(value, dict):
+            # the old implementation searched RowData's subclass hierarchy by name for every nested dict
+            subclass = next(c for c in _all_subclasses(RowData) if c.__name__ == key.capitalize())
+            tree[key] = legacy_from_tree(LEGACY_CLASSES[subclass.__name__], value)
+    return cls(**tree)
+
+
+def _all_subclasses(cls: type):
+    for subclass in cls.__subclasses__():
+        yield from _all_subclasses(subclass)
+        yield subclass
+
+
+def legacy_build(cls: type, **kwargs):
+    """RowData.build before the row mappers were compiled"""
+    tree = nested_dict()
+    for name, value in kwargs.items():
+        subnames = name.split('.')
+        subtree = tree
+        for subtree_name in subnames[:-1]:
+            subtree = subtree[subtree_name]
+        subtree[subnames[-1]] = value
+    return legacy_from_tree(cls, tree)
+
+
+def measure_memory(build) -> int:
+    tracemalloc.start()
+    objects = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main(amount: int = 2000):
+    rows = make_rows(amount)
+    dict_rows = [dict(zip(COLUMNS, row)) for row in rows]
+    legacy_waifu = LEGACY_CLASSES['Waifu']
+
+    def legacy():
+        return [legacy_build(legacy_waifu, **row) for row in dict_rows]
+
+    def compiled():
+        mapper = Waifu.mapper(COLUMNS)
+        return [mapper(row) for row in rows]
+
+    repeat = 20
+    legacy_time = timeit.timeit(legacy, number=repeat) / repeat
+    compiled_time = timeit.timeit(compiled, number=repeat) / repeat
+    legacy_memory = measure_memory(legacy)
+    compiled_memory = measure_memory(compiled)
+
+    print(f'{amount} rows with {len(COLUMNS)} columns each')
+    print(f'tree build, __dict__ classes: {legacy_time * 1e3:8.2f} ms  {legacy_memory / amount:8.0f} B/row')
+    print(f'compiled mapper, slotted:     {compiled_time * 1e3:8.2f} ms  {compiled_memory / amount:8.0f} B/row')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,121 @@
+"""Generate a synthetic shinobu.db with a realistic shape for benchmarks.
+
+Usage: python -m benchmarks.synthetic path [--users N] [--characters N] [--batches N] [--packs N] [--waifus N]
+"""
+import argparse
+import random
+import sqlite3
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from utils.migrations import migrate
+
+# value, name, colour, weight, refund, upgrade cost, auto upgrade
+RARITIES = [
+    (1, 'Common', 0x95a5a6, 70, 5, 20, True),
+    (2, 'Rare', 0x3498db, 22, 15, 60, True),
+    (3, 'Epic', 0x9b59b6, 7, 50, 200, False),
+    (4, 'Legendary', 0xf1c40f, 1, 200, None, False),
+]
+CHUNK = 50_000
+
+FIRST_NAMES = ['Shinobu', 'Hitagi', 'Mayoi', 'Tsubasa', 'Nadeko', 'Karen', 'Tsukihi', 'Suruga', 'Koyomi', 'Sodachi',
+               'Ougi', 'Yotsugi', 'Izuko', 'Rin', 'Asuka', 'Rei', 'Misato', 'Haruhi', 'Yuki', 'Mikuru']
+LAST_NAMES = ['Oshino', 'Senjougahara', 'Hachikuji', 'Hanekawa', 'Sengoku', 'Araragi', 'Kanbaru', 'Oikura',
+              'Ononoki', 'Gaen', 'Tohsaka', 'Soryu', 'Ayanami', 'Katsuragi', 'Suzumiya', 'Nagato', 'Asahina']
+
+
+@dataclass(frozen=True)
+class Config:
+    users: int = 2_000
+    characters: int = 100_000
+    batches: int = 200
+    packs: int = 10
+    waifus: int = 1_000_000
+    seed: int = 0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def _chunked_insert(db: sqlite3.Connection, sql: str, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            db.executemany(sql, chunk)
+            chunk.clear()
+    db.executemany(sql, chunk)
+
+
+def generate(path, config: Config = Config()) -> sqlite3.Connection:
+    """Create (or overwrite) a database at path filled according to config, the connection is returned"""
+    rng = random.Random(config.seed)
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    db = sqlite3.connect(path, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('BEGIN IMMEDIATE')
+    migrate(db)
+
+    db.executemany('INSERT INTO rarity(value, name, colour, weight, refund, upgrade_cost, auto_upgrade)'
+                   ' VALUES(?,?,?,?,?,?,?)', RARITIES)
+    batches = [f'Batch {i}' for i in range(config.batches)]
+    db.executemany('INSERT INTO batch(name) VALUES(?)', [(b,) for b in batches])
+    # most characters are common, few are legendary
+    rarity_weights = [r[3] for r in RARITIES]
+    _chunked_insert(db, 'INSERT INTO character(id, name, image_url, series, rarity, batch) VALUES(?,?,?,?,?,?)',
+                    ((i, f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}',
+                      f'https://example.com/characters/{i}.png', f'Series {i // 20}',
+                      rng.choices(RARITIES, rarity_weights)[0][0], rng.choice(batches))
+                     for i in range(config.characters)))
+
+    packs = [f'Pack {i}' for i in range(config.packs)]
+    db.executemany("INSERT INTO pack(name, cost, description, start_date) VALUES(?, 10, '', DATE('now', '-1 day'))",
+                   [(p,) for p in packs])
+    db.executemany('INSERT INTO batch_in_pack(batch, pack, weight) VALUES(?,?,?)',
+                   [(b, p, rng.randint(1, 5)) for p in packs
+                    for b in rng.sample(batches, max(1, config.batches // 4))])
+
+    db.executemany('INSERT INTO user(id, balance, mal_username) VALUES(?,?,?)',
+                   [(u, 10 ** 9, f'user{u}' if u % 3 == 0 else None) for u in range(config.users)])
+
+    # collection sizes vary a lot between users, a user owns every character at most once
+    sizes = [rng.paretovariate(1.5) for _ in range(config.users)]
+    scale = config.waifus / sum(sizes)
+    _chunked_insert(db, 'INSERT INTO waifu(user, character, rarity) VALUES(?,?,?)',
+                    ((u, c, rng.choices(RARITIES, rarity_weights)[0][0])
+                     for u, size in enumerate(sizes)
+                     for c in rng.sample(range(config.characters), min(config.characters, round(size * scale)))))
+
+    db.execute('COMMIT')
+    db.execute('ANALYZE')
+    return db
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = Config()
+    for name in ('users', 'characters', 'batches', 'packs', 'waifus', 'seed'):
+        parser.add_argument(f'--{name}', type=int, default=getattr(defaults, name))
+
+
+def config_from_arguments(args: argparse.Namespace) -> Config:
+    return Config(users=args.users, characters=args.characters, batches=args.batches, packs=args.packs,
+                  waifus=args.waifus, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    add_arguments(parser)
+    args = parser.parse_args()
+    db = generate(args.path, config_from_arguments(args))
+    counts = {table: db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('user', 'character', 'batch', 'pack', 'waifu')}
+    print(f'generated {args.path}: {counts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Stress the trade engine with thousands of concurrent, overlapping queue/sign/cancel operations.
+
+Checks that nothing deadlocks, that no update is lost (the final balances and waifu owners are the ones obtained by
+replaying the signed changes in commit order), that the user locks are evicted again and that a minimum share of
+the operations gets signed.
+
+Usage: python -m benchmarks.trade_stress [operations] [users]
+"""
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from api.expected_errors import ExpectedCommandError
+from utils.database import Database, Waifu
+from utils.migrations import migrate
+from utils.trade import Change, MoneyTransfer, TradeEngine, WaifuTransfer
+
+START_BALANCE = 1000
+WAIFUS_PER_USER = 5
+TIMEOUT = 300
+# operations ending in a sign, the others ran into conflicting operations, declined or cancelled
+MIN_SIGNED_SHARE = 0.25
+
+
+def populate(db, users: int):
+    migrate(db)
+    db.execute("INSERT INTO rarity(value, name, colour, weight, refund) VALUES(1, 'Common', 0, 1, 1)")
+    db.execute("INSERT INTO batch(name) VALUES('stress')")
+    db.executemany('INSERT INTO user(id, balance) VALUES(?, ?)', [(u, START_BALANCE) for u in range(users)])
+    waifus = range(users * WAIFUS_PER_USER)
+    # one character per waifu, so that a transfer can't fail because the receiver owns the character already
+    db.executemany("INSERT INTO character(id, name, series, rarity, batch) VALUES(?, ?, 'Stress', 1, 'stress')",
+                   [(w, f'Character {w}') for w in waifus])
+    db.executemany('INSERT INTO waifu(id, user, character, rarity) VALUES(?, ?, ?, 1)',
+                   [(w, w % users, w) for w in waifus])
+
+
+def owned_waifus(db, user_id: int) -> list[Waifu]:
+    return list(Waifu.select_many(db, """
+    SELECT waifu.id, waifu.user AS "user.id",
+           character.id AS "character.id", character.name AS "character.name",
+           character.series AS "character.series",
+           rarity.value AS "rarity.value", rarity.name AS "rarity.name"
+    FROM waifu
+    JOIN character ON character.id = waifu.character
+    JOIN rarity ON rarity.value = waifu.rarity
+    WHERE waifu.user = ?
+    """, [user_id]))
+
+
+async def stress(operations: int, users: int):
+    db = Database(Path(tempfile.mkdtemp()) / 'stress.db')
+    await db.transaction(populate, users)
+    engine = TradeEngine()
+    # signed changes in commit order
+    signed: list[Change] = []
+    outcomes = Counter()
+
+    async def operation():
+        owner = random.randrange(users)
+        # the users whose queues the operation touches
+        involved = [owner]
+        try:
+            for _ in range(random.randint(1, 3)):
+                to_id = random.choice([u for u in range(users) if u != owner])
+                waifus = await db.read(owned_waifus, owner)
+                if waifus and random.random() < 0.3:
+                    change = WaifuTransfer(from_id=owner, to_id=to_id, waifu=random.choice(waifus))
+                else:
+                    change = MoneyTransfer(from_id=owner, to_id=to_id, amount=random.randint(1, 50))
+                await engine.queue(db, owner, change)
+                outcomes['queued'] += 1
+
+            if random.random() < 0.1:
+                cancelled = await engine.cancel(db, owner)
+                outcomes['cancelled'] += cancelled
+                return
+
+            async def confirm(_: list[Change]) -> bool:
+                await asyncio.sleep(0)
+                return random.random() < 0.9
+
+            # overlapping sets of signers, given in random order
+            signers = [owner, *random.sample(range(users), random.randint(0, 2))]
+            random.shuffle(signers)
+            involved = signers
+            if (changes := await engine.sign(db, signers, confirm)) is None:
+                outcomes['declined signs'] += 1
+            else:
+                signed.extend(changes)
+                outcomes['signs'] += 1
+        except ExpectedCommandError:
+            # not enough money, waifu given away in the meantime, ... Like a user would, the queues are cleared,
+            # otherwise the change that can't be executed would make every later sign of them fail as well
+            outcomes['rejected'] += 1
+            for user in set(involved):
+                await engine.cancel(db, user)
+
+    start = time.perf_counter()
+    await asyncio.wait_for(asyncio.gather(*(operation() for _ in range(operations))), TIMEOUT)
+    elapsed = time.perf_counter() - start
+
+    balances = Counter({u: START_BALANCE for u in range(users)})
+    owners = {w: w % users for w in range(users * WAIFUS_PER_USER)}
+    for change in signed:
+        if isinstance(change, MoneyTransfer):
+            balances[change.from_id] -= change.amount
+            balances[change.to_id] += change.amount
+        else:
+            assert owners[change.waifu.id] == change.from_id, f'{change} was signed for a waifu it did not own'
+            owners[change.waifu.id] = change.to_id
+
+    def check(db_) -> list[str]:
+        errors = []
+        if dict(db_.execute('SELECT id, balance FROM user')) != balances:
+            errors.append('the balances differ from the signed changes')
+        if dict(db_.execute('SELECT id, user FROM waifu')) != owners:
+            errors.append('the waifu owners differ from the signed changes')
+        return errors
+
+    errors = await db.read(check)
+    if len(engine.locks):
+        errors.append(f'{len(engine.locks)} user locks were not evicted')
+    if outcomes['signs'] < MIN_SIGNED_SHARE * operations:
+        errors.append(f"only {outcomes['signs']} of the {operations} operations were signed")
+    db.close()
+
+    print(f'{operations} operations on {users} users in {elapsed:.1f}s: {dict(outcomes)}')
+    print(f'{len(signed)} changes signed, {sum(isinstance(c, WaifuTransfer) for c in signed)} of them waifu transfers')
+    for error in errors:
+        print(f'ERROR: {error}')
+    if errors:
+        sys.exit(1)
+
+
+def main(operations: int = 5000, users: int = 20):
+    asyncio.run(stress(operations, users))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
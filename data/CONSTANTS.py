@@ -1,7 +1,11 @@
+from datetime import timedelta
 from pathlib import Path
 
 MAX_MESSAGE_LENGTH = 2000
 DB_PATH = Path('data') / 'shinobu.db'
+# Prometheus text format, rewritten every METRICS_INTERVAL
+METRICS_PATH = Path('data') / 'metrics.prom'
+METRICS_INTERVAL = timedelta(minutes=1)
 CMD_PREFIX = '.'
 CURRENCY = '🍩'
 YES = '👍'
@@ -15,3 +19,18 @@ SEND = '🎁'
 CONFIRM = '✅'
 CANCEL = '❌'
 ANNOUNCEMENT_CHANNEL_ID = 1000444006230134784
+MAL_METADATA_TTL = timedelta(days=7)
+MAL_METADATA_MAX_STALENESS = timedelta(days=90)
+MAL_SEARCH_TTL = timedelta(days=30)
+MAL_SEARCH_NEGATIVE_TTL = timedelta(days=1)
+# requests per second and burst size per host
+HOST_RATE_LIMITS = {'myanimelist.net': (2, 5)}
+MAL_CONCURRENCY = 8
+# outgoing requests other than Discord's, see utils.http
+HTTP_LIMIT_PER_HOST = 8
+HTTP_TIMEOUT = timedelta(seconds=30)
+HTTP_RETRIES = 2
+HTTP_BACKOFF = timedelta(seconds=1)
+# character images checked at once, and how long a check of an image is trusted (see utils.image_check)
+IMAGE_CHECK_CONCURRENCY = 32
+IMAGE_CHECK_MAX_AGE = timedelta(days=7)
@@ -4,34 +4,37 @@ import nextcord
 from nextcord.ext import commands
 
 from api import shinobu
-from utils import database
 
 
 class CallNotification(commands.Cog):
-    def __init__(self):
+    def __init__(self, bot: shinobu.Shinobu):
+        self.bot = bot
         self.COOLDOWN_TIME = 5
         self.last_used = 0
-        self.voiceid_to_textid = {
-            row['voice_id']: row['text_id']
-            for row in database.connect().execute(
-                'SELECT voice_id, text_id FROM voice_to_text'
-            )
-        }
+        self._voiceid_to_textid = None
+
+    async def voiceid_to_textid(self) -> dict[int, int]:
+        if self._voiceid_to_textid is None:
+            self._voiceid_to_textid = dict(await self.bot.db.read(
+                lambda db: db.execute('SELECT voice_id, text_id FROM voice_to_text').fetchall()
+            ))
+        return self._voiceid_to_textid
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member: nextcord.Member,
                                     before: nextcord.VoiceState,
                                     after: nextcord.VoiceState):
         """Notifies certain channels when someone starts a call"""
+        voiceid_to_textid = await self.voiceid_to_textid()
         if (time.time() < self.last_used + self.COOLDOWN_TIME
             or after.channel is None
             or after.channel.id == getattr(before.channel, 'id', None)
             or len(after.channel.members) > 1
-            or after.channel.id not in self.voiceid_to_textid
+            or after.channel.id not in voiceid_to_textid
             ): return
         text_channel = nextcord.utils.get(
             member.guild.channels,
-            id=self.voiceid_to_textid[after.channel.id]
+            id=voiceid_to_textid[after.channel.id]
         )
         await text_channel.send(embed=nextcord.Embed(
             description=f"{member.mention} started a call.",
@@ -41,4 +44,4 @@ class CallNotification(commands.Cog):
 
 
 def setup(bot: shinobu.Shinobu):
-    bot.add_cog(CallNotification())
+    bot.add_cog(CallNotification(bot))
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from nextcord.ext import commands
+
+from api.expected_errors import ExpectedCommandError
+from api.my_context import Context
+from api.shinobu import Shinobu
+from data.CONSTANTS import IMAGE_CHECK_CONCURRENCY, IMAGE_CHECK_MAX_AGE
+from utils.catalog_search import CATALOG_INDEX
+from utils.image_check import check_catalog_images
+
+
+class Catalog(commands.Cog):
+    @commands.command(aliases=['c'])
+    async def char(self, ctx: Context, *search_terms: str):
+        """Search every character that can be found in packs."""
+        if not (query := ' '.join(search_terms)):
+            raise ExpectedCommandError('Please specify a search query.')
+
+        results = await ctx.bot.db.read(CATALOG_INDEX.search_characters, query)
+        if not results:
+            raise ExpectedCommandError("I couldn't find any results.")
+        padding = max(len(c.name) for c in results)
+        await ctx.send_paginated('\n'.join(f"{c.name:<{padding}} - {c.rarity} [{c.series}] ({c.batch})"
+                                           for c in results),
+                                 prefix='```md\n', suffix='```')
+
+    @commands.command(aliases=['s'])
+    async def series(self, ctx: Context, *search_terms: str):
+        """Search every series that has characters in packs."""
+        if not (query := ' '.join(search_terms)):
+            raise ExpectedCommandError('Please specify a search query.')
+
+        results = await ctx.bot.db.read(CATALOG_INDEX.search_series, query)
+        if not results:
+            raise ExpectedCommandError("I couldn't find any results.")
+        padding = max(len(s.name) for s in results)
+        await ctx.send_paginated('\n'.join(f"{s.name:<{padding}} - {s.characters} characters ({', '.join(s.batches)})"
+                                           for s in results),
+                                 prefix='```md\n', suffix='```')
+
+    @commands.is_owner()
+    @commands.command()
+    async def checkimages(self, ctx: Context, max_age_days: float = IMAGE_CHECK_MAX_AGE.days):
+        """Check the characters' images that haven't been checked for the given number of days."""
+        async with ctx.typing():
+            counts = await check_catalog_images(ctx.bot.db, ctx.bot.http_client, timedelta(days=max_age_days),
+                                                IMAGE_CHECK_CONCURRENCY)
+        await ctx.info(f"Checked {counts['ok'] + counts['dead']} images, {counts['dead']} of them are dead.")
+
+
+def setup(bot: Shinobu):
+    bot.add_cog(Catalog())
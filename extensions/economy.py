@@ -1,82 +1,173 @@
+import asyncio
 import logging
-from typing import AsyncIterator
-from datetime import datetime, timedelta
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 
-import aiohttp
 import nextcord
-from nextcord.ext import commands, tasks
+from nextcord.ext import commands
 
 from api.my_context import Context
 from api.shinobu import Shinobu
-from data.CONSTANTS import CURRENCY, ANNOUNCEMENT_CHANNEL_ID
-from utils import database
+from data.CONSTANTS import CURRENCY, ANNOUNCEMENT_CHANNEL_ID, MAL_CONCURRENCY
 from utils import mal_rss
-from utils.database import User
-from utils.mal_scraper import Manga, Anime
+from utils.database import DB, User
+from utils.mal_scraper import Manga, Anime, Content, RATE_LIMITER
+from utils.mal_titles import add_mal_titles
+from utils.scheduler import CatchUp, claim_idempotency_key
 
 logger = logging.getLogger(__name__)
 
+# birthdays are YYYY-MM-DD, unset ('' as well as NULL) or malformed ones would sort before any date
+BIRTHDAY_USERS_QUERY = 'SELECT * FROM user WHERE birthday <= ? AND birthday IS NOT NULL AND length(birthday) = 10'
+MAL_USERS_QUERY = "SELECT * FROM user WHERE mal_username > ''"
+# a row that was changed since the old amount was read (by another reward run) isn't touched, rowcount is 0 then
+CONSUME_MEDIA = """
+INSERT INTO consumed_media(user, type, id, amount) VALUES(?,?,?,?)
+ON CONFLICT(user, type, id) DO UPDATE SET amount=excluded.amount WHERE consumed_media.amount = ?
+"""
+
 
 class Economy(commands.Cog):
     def __init__(self, bot: Shinobu):
         self.bot = bot
-        self.birthday_task.start()
-        self.reward_media_consumption_task.start()
-
-    @tasks.loop(hours=12)
-    async def birthday_task(self):
-        await self.birthday()
-
-    async def birthday(self):
-        db = database.connect()
-        for user_row in User.select_many(db, "SELECT * FROM user WHERE birthday == DATE('now', 'localtime')"):
-            with db:
-                db.execute('UPDATE user SET balance=balance+100, birthday=? WHERE id=?',
-                           [add_years(user_row.birthday, 1), user_row.id])
+        # the scheduled job and .update mustn't reward the same consumptions at the same time
+        self._reward_lock = asyncio.Lock()
+        # the birthday job catches up on missed days by itself, see birthday
+        bot.scheduler.register('birthday', lambda scheduled: self.birthday(scheduled.date()),
+                               timedelta(hours=12), CatchUp.ONCE)
+        bot.scheduler.register('reward_media_consumption', lambda _: self.reward_media_consumption(),
+                               timedelta(hours=6), CatchUp.ONCE)
+
+    def cog_unload(self):
+        self.bot.scheduler.unregister('birthday')
+        self.bot.scheduler.unregister('reward_media_consumption')
+
+    async def birthday(self, today: date):
+        db = self.bot.db
+        # <= rather than ==: birthdays that passed while the bot was offline are celebrated late
+        for user_row in await db.select_many(User, BIRTHDAY_USERS_QUERY, [today.isoformat()]):
+            if not await db.transaction(give_birthday_present, user_row, today):
+                continue
             user: nextcord.User = self.bot.get_user(user_row.id)
             announcement_channel: nextcord.TextChannel = self.bot.get_channel(ANNOUNCEMENT_CHANNEL_ID)
             await announcement_channel.send(f'🎉🎉🎉  Happy Birthday {user.mention}!  🎉🎉🎉'
                                             f'\nAs a present, you get 100 {CURRENCY}!')
             logger.info(f'gifted 100 to {user.name} as a birthday present!')
 
-    @tasks.loop(hours=6)
-    async def reward_media_consumption_task(self):
-        async for _ in self.reward_media_consumption():
-            pass
+    async def reward_media_consumption(self) -> list[tuple[User, int]]:
+        async with self._reward_lock:
+            return await self._reward_media_consumption()
 
-    @staticmethod
-    async def reward_media_consumption() -> AsyncIterator[tuple[User, int]]:
+    async def _reward_media_consumption(self) -> list[tuple[User, int]]:
         logger.debug('rewarding media consumption...')
-        db = database.connect()
-
-        async with aiohttp.ClientSession() as session:
-            for user in User.select_many(db, "SELECT * FROM user WHERE mal_username > ''"):
-                for content_type in Anime, Manga:
-                    content = await mal_rss.new_mal_content(db=db, session=session, content_type=content_type,
-                                                            user_id=user.id, mal_username=user.mal_username)
-                    with db:
-                        for series_id, old_amount, consumed_amount in content:
-                            amount = consumed_amount - old_amount
-                            reward = await content_type.from_id(series_id).calculate_reward(amount)
-                            db.execute('UPDATE user SET balance=balance+? WHERE id=?',
-                                       (reward, user.id))
-                            db.execute('REPLACE INTO consumed_media(user,type,id,amount) VALUES(?,?,?,?)',
-                                       (user.id, content_type.domain_suffix, series_id, consumed_amount))
-                            logger.info(f'user {user.id} consumed {consumed_amount - old_amount}'
-                                        f' bits of {series_id} ({content_type.domain_suffix})')
-                            yield user, reward
+        db = self.bot.db
+        start_time = time.perf_counter()
+        requests_before = RATE_LIMITER.requests.copy()
+        semaphore = asyncio.Semaphore(MAL_CONCURRENCY)
+        users = await db.select_many(User, MAL_USERS_QUERY)
+
+        async def new_content(user: User, content_type: type[Content]) -> tuple[list[tuple[int, int, int]],
+                                                                                list[mal_rss.MalFeed],
+                                                                                list[tuple[str, int, str]]]:
+            async with semaphore:
+                content, feeds, titles = await mal_rss.new_mal_content(db=db, client=self.bot.http_client,
+                                                                       content_type=content_type, user_id=user.id,
+                                                                       mal_username=user.mal_username)
+                return list(content), feeds, titles
+
+        jobs = [(user, content_type) for user in users for content_type in (Anime, Manga)]
+        feeds = await asyncio.gather(*(new_content(*job) for job in jobs), return_exceptions=True)
+
+        consumptions = []
+        new_feeds = {}
+        titles = []
+        for (user, content_type), result in zip(jobs, feeds):
+            if isinstance(result, BaseException):
+                logger.error(f"failed to get {user.mal_username}'s {content_type.domain_suffix} feed",
+                             exc_info=result)
+                continue
+            content, new_feeds[user.id, content_type], feed_titles = result
+            titles.extend(feed_titles)
+            consumptions.extend((user, content_type, *c) for c in content)
+
+        # series consumed by multiple users are only looked up once
+        async def series_content(content_type: type[Content], series_id: int) -> Content:
+            async with semaphore:
+                return await self.bot.mal_cache.get(content_type, series_id)
+
+        series = list({(content_type, series_id) for _, content_type, series_id, *_ in consumptions})
+        contents = dict(zip(series, await asyncio.gather(*(series_content(*s) for s in series),
+                                                         return_exceptions=True)))
+
+        rewards = []
+        for user, content_type, series_id, old_amount, consumed_amount in consumptions:
+            content = contents[content_type, series_id]
+            if isinstance(content, BaseException):
+                logger.error(f'failed to get {content_type.domain_suffix} {series_id}', exc_info=content)
+                # keep the old feed validators so that the feed is checked again next time
+                new_feeds.pop((user.id, content_type), None)
+                continue
+            try:
+                reward = await content.calculate_reward(consumed_amount - old_amount)
+            except Exception:
+                logger.exception(f'failed to calculate the reward of {content_type.domain_suffix} {series_id}')
+                new_feeds.pop((user.id, content_type), None)
+                continue
+            rewards.append((user, content_type.domain_suffix, series_id, old_amount, consumed_amount, reward))
+            logger.info(f'user {user.id} consumed {consumed_amount - old_amount}'
+                        f' bits of {series_id} ({content_type.domain_suffix})')
+
+        users_by_id = {user.id: user for user in users}
+        rewarded = await db.transaction(reward_consumptions, [(user.id, *r) for user, *r in rewards],
+                                        [f for fs in new_feeds.values() for f in fs], titles)
+
+        requests = RATE_LIMITER.requests - requests_before
+        logger.info(f'rewarded media consumption of {len(users)} users in {time.perf_counter() - start_time:.1f}s'
+                    f' ({len(rewarded)} rewards, requests: {dict(requests) or 0})')
+        return [(users_by_id[user_id], reward) for user_id, reward in rewarded]
 
     @commands.cooldown(1, 60)
     @commands.command(aliases=['up'])
     async def update(self, ctx: Context):
         """Force a full update of everyone's earnings"""
         if lines := [f"{ctx.bot.get_user(user.id).mention} earned {amount} {CURRENCY}"
-                     async for user, amount in self.reward_media_consumption()]:
+                     for user, amount in await self.reward_media_consumption()]:
             await ctx.info(title='Success!', description='\n'.join(lines))
         else:
             await ctx.info('Nothing changed...')
 
 
+def reward_consumptions(db: DB, rewards: list[tuple[int, str, int, int, int, int]], feeds: list[mal_rss.MalFeed],
+                        titles: list[tuple[str, int, str]]) -> list[tuple[int, int]]:
+    """Apply rewards given as (user id, content type, series id, old amount, consumed amount, reward) tuples,
+    remember the versions of the feeds they were taken from and the titles of the series in them.
+    A reward is only paid if the stored amount still is the old amount it was calculated from, returns the
+    (user id, reward) of the paid ones."""
+    balance_changes = defaultdict(int)
+    paid = []
+    for user_id, type_, series_id, old_amount, consumed_amount, reward in rewards:
+        if db.execute(CONSUME_MEDIA, [user_id, type_, series_id, consumed_amount, old_amount]).rowcount:
+            balance_changes[user_id] += reward
+            paid.append((user_id, reward))
+    db.executemany('UPDATE user SET balance=balance+? WHERE id=?',
+                   [(reward, user_id) for user_id, reward in balance_changes.items()])
+    mal_rss.save_mal_feeds(db, feeds)
+    add_mal_titles(db, titles)
+    return paid
+
+
+def give_birthday_present(db: DB, user: User, today: date) -> bool:
+    """Give the present for the user's birthday unless it already has been, and move it to the next year"""
+    if not claim_idempotency_key(db, f'birthday:{user.id}:{user.birthday}'):
+        return False
+    next_birthday = add_years(user.birthday, 1)
+    while next_birthday <= today.isoformat():
+        next_birthday = add_years(next_birthday, 1)
+    db.execute('UPDATE user SET balance=balance+100, birthday=? WHERE id=?', [next_birthday, user.id])
+    return True
+
+
 def add_years(date_: str, amount: int) -> str:
     return str(int(date_[:4]) + amount) + date_[4:]
 
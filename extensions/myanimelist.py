@@ -1,13 +1,16 @@
+from functools import partial
 from typing import Optional, Collection
 
-import aiohttp
 from nextcord.ext import commands
 
 from api.expected_errors import ExpectedCommandError
 from api.my_context import Context
 from api.shinobu import Shinobu
 from utils.bing_search import search, first_match
+from utils.http import HttpClient
+from utils.database import Database
 from utils.mal_scraper import Anime, Manga, Content
+from utils.mal_titles import MAL_TITLE_INDEX
 
 
 class MyAnimeList(commands.Cog):
@@ -28,21 +31,24 @@ async def find_series(ctx: Context, search_terms: Collection[str], content_type:
     if len(search_terms) == 0:
         raise ExpectedCommandError('Please specify a search query.')
 
-    series_id = await search_first_mal_id(content_type.domain_suffix, ' '.join(search_terms))
+    series_id = await ctx.bot.mal_search_cache.get(content_type.domain_suffix, ' '.join(search_terms),
+                                                   partial(search_first_mal_id, ctx.bot.db, ctx.bot.http_client))
     if series_id is None:
         raise ExpectedCommandError("I couldn't find any results.")
 
     embed_msg = await ctx.send("*Getting the information from MyAnimeList.net...*")
     async with ctx.typing():
-        scraper = content_type.from_id(series_id)
+        scraper = await ctx.bot.mal_cache.get(content_type, series_id)
         embed = await scraper.to_embed()
         await embed_msg.edit(content=" ", embed=embed)
 
 
-async def search_first_mal_id(domain_suffix: str, query: str) -> Optional[int]:
-    async with aiohttp.ClientSession() as session:
-        search_results = search(f'site:myanimelist.net/{domain_suffix} {query}', session)
-        match = await first_match(rf'https://myanimelist\.net/{domain_suffix}/(\d+)/[^/]+', search_results)
+async def search_first_mal_id(db: Database, client: HttpClient, domain_suffix: str, query: str) -> Optional[int]:
+    # series users consumed or looked up before are found locally, the web search is slow and brittle
+    if (id_ := await db.read(MAL_TITLE_INDEX.lookup, domain_suffix, query)) is not None:
+        return id_
+    search_results = search(f'site:myanimelist.net/{domain_suffix} {query}', client)
+    match = await first_match(rf'https://myanimelist\.net/{domain_suffix}/(\d+)/[^/]+', search_results)
     if match:
         return int(match.group(1))
 
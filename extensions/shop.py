@@ -1,4 +1,5 @@
 import logging
+import re
 from typing import Union
 
 import nextcord
@@ -9,10 +10,9 @@ from api.my_context import Context
 from api.shinobu import Shinobu
 from data.CONSTANTS import CURRENCY
 from extensions.economy import income_and_new_last_withdrawal
-from utils import database
-from utils.database import Pack, User, DB
-from utils.waifus import buy_pack, CURRENT_PREDICATE, list_waifus, Refund, find_waifu
-from utils.interactions import waifu_interactions, user_interactions
+from utils.database import Database, Pack, User
+from utils.waifus import buy_pack, buy_packs, CURRENT_PREDICATE, WaifuListPages, Refund, Upgrade, find_waifu
+from utils.interactions import waifu_buttons, user_buttons
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +21,32 @@ class Shop(commands.Cog):
     @commands.command(aliases=['p'])
     @utils.trade.forbid
     async def pack(self, ctx: Context, *pack_name: str):
-        """Buy a pack with the given name. List all currently available packs if you don't give a pack name."""
-        db = database.connect()
-
-        if pack_name := ' '.join(pack_name):
-            waifu, duplicate = await buy_pack(db, ctx.author.id, pack_name)
+        """Buy a pack with the given name. List all currently available packs if you don't give a pack name.
+        Append e.g. x10 to the pack name to buy ten packs at once."""
+        db = ctx.bot.db
+
+        amount = 1
+        if len(pack_name) > 1 and (amount_match := re.fullmatch(r'[xX](\d+)', pack_name[-1])):
+            amount = int(amount_match.group(1))
+            pack_name = pack_name[:-1]
+
+        # any amount but one goes through buy_packs, which rejects the amounts that can't be bought (x0, ...)
+        if (pack_name := ' '.join(pack_name)) and amount != 1:
+            results = await db.transaction(buy_packs, ctx.author.id, pack_name, amount)
+            lines = []
+            for waifu, duplicate in results:
+                line = f"{waifu.rarity.name} - {waifu.character.name} [{waifu.character.series}]"
+                if isinstance(duplicate, Refund):
+                    line += f" (refunded for {duplicate.amount} {CURRENCY})"
+                elif isinstance(duplicate, Upgrade):
+                    line += " (upgraded)"
+                lines.append(line)
+            refunded = sum(d.amount for _, d in results if isinstance(d, Refund))
+            lines.append(f"\nBought {amount} packs, {refunded} {CURRENCY} were refunded for duplicates.")
+            await ctx.send_paginated('\n'.join(lines), prefix='```md\n', suffix='```')
+
+        elif pack_name:
+            waifu, duplicate = await db.transaction(buy_pack, ctx.author.id, pack_name)
             embed = waifu.to_embed()
 
             allow_interactions = True
@@ -37,12 +58,14 @@ class Shop(commands.Cog):
                     duplicate_msg = f"Your waifu got upgraded to **{duplicate.upgraded_rarity.name}**!"
                 embed.add_field(name='Duplicate', value=duplicate_msg)
 
-            msg = await ctx.send(embed=embed)
             if allow_interactions:
-                await waifu_interactions(ctx=ctx, db=db, msg=msg, waifu=waifu)
+                menu = waifu_buttons(ctx=ctx, db=db, waifu=waifu)
+                await menu.run(await ctx.send(embed=embed, view=menu))
+            else:
+                await ctx.send(embed=embed)
 
         else:
-            packs = Pack.select_many(db, f'SELECT * FROM pack WHERE {CURRENT_PREDICATE}')
+            packs = await db.select_many(Pack, f'SELECT * FROM pack WHERE {CURRENT_PREDICATE}')
 
             embed = nextcord.Embed(colour=nextcord.Colour.gold())
             for p in packs:
@@ -72,22 +95,21 @@ class Shop(commands.Cog):
             if maybe_user:
                 query = maybe_user + ' ' + query
 
-        db = database.connect()
+        db = ctx.bot.db
 
         if query:
-            waifu = find_waifu(db, user.id, query)
-            msg = await ctx.send(embed=waifu.to_embed())
+            waifu = await db.read(find_waifu, user.id, query)
             if user == ctx.author:
-                await waifu_interactions(ctx=ctx, db=db, msg=msg, waifu=waifu)
+                menu = waifu_buttons(ctx=ctx, db=db, waifu=waifu)
+                await menu.run(await ctx.send(embed=waifu.to_embed(), view=menu))
+            else:
+                await ctx.send(embed=waifu.to_embed())
 
         else:
-            waifus = list_waifus(db, user.id)
-            padding = max(len(w.character.name) for w in waifus)
-            waifu_str = '\n'.join(f"{w.character.name:<{padding}} - {w.rarity.name}" for w in waifus)
-            await ctx.send_paginated(waifu_str, prefix='```md\n', suffix='```')
+            await ctx.send_lazy_pager(WaifuListPages(db, user.id))
 
     @staticmethod
-    def income_msg(db: DB, discord_user: nextcord.User, db_user: User, is_author: bool):
+    async def income_msg(db: Database, discord_user: nextcord.User, db_user: User, is_author: bool):
         income, new_last_withdrawal = income_and_new_last_withdrawal(db_user)
 
         if not income:
@@ -95,9 +117,8 @@ class Shop(commands.Cog):
         elif not is_author:
             income_msg = f'  (Has yet to withdraw {income} {CURRENCY})'
         else:
-            with db:
-                db.execute('UPDATE user SET balance=balance+?, last_withdrawal=? WHERE id=?',
-                           [income, new_last_withdrawal, discord_user.id])
+            await db.execute('UPDATE user SET balance=balance+?, last_withdrawal=? WHERE id=?',
+                             [income, new_last_withdrawal, discord_user.id])
             logger.info(f'{discord_user.name} withdrew {income} from their passive income')
             income_msg = f'  (Withdrew {income} {CURRENCY})'
 
@@ -109,8 +130,8 @@ class Shop(commands.Cog):
         maybe_user = await self.maybe_to_user(ctx, user)
         user = maybe_user if isinstance(maybe_user, nextcord.User) else ctx.author
 
-        db = database.connect()
-        db_user = User.select_one(db, 'SELECT * FROM user WHERE id=?', [user.id])
+        db = ctx.bot.db
+        db_user = await db.select_one(User, 'SELECT * FROM user WHERE id=?', [user.id])
 
         embed = nextcord.Embed(color=nextcord.colour.Colour.blue(),  # todo custom color
                               title=f'{user}',
@@ -118,10 +139,9 @@ class Shop(commands.Cog):
                               )
         if user.avatar:
             embed.set_thumbnail(url=str(user.avatar.url))
-        embed.add_field(name='Balance', value=self.income_msg(db, user, db_user, user == ctx.author))
-        db.close()
-        msg = await ctx.send(embed=embed)
-        await user_interactions(ctx=ctx, msg=msg, target_user=user)
+        embed.add_field(name='Balance', value=await self.income_msg(db, user, db_user, user == ctx.author))
+        menu = user_buttons(ctx=ctx, target_user=user)
+        await menu.run(await ctx.send(embed=embed, view=menu))
 
 
 def setup(bot: Shinobu):
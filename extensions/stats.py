@@ -0,0 +1,52 @@
+import logging
+import os
+from datetime import datetime
+
+from nextcord.ext import commands
+
+from api.my_context import Context
+from api.shinobu import Shinobu
+from data.CONSTANTS import METRICS_PATH, METRICS_INTERVAL
+from utils.metrics import METRICS, Histogram
+from utils.scheduler import CatchUp
+
+logger = logging.getLogger(__name__)
+
+
+class Stats(commands.Cog):
+    def __init__(self, bot: Shinobu):
+        self.bot = bot
+        bot.scheduler.register('write_metrics', self.write_metrics, METRICS_INTERVAL, CatchUp.SKIP)
+
+    def cog_unload(self):
+        self.bot.scheduler.unregister('write_metrics')
+
+    @staticmethod
+    async def write_metrics(_: datetime):
+        # written next to the file and then moved, so that scrapers never read half a file
+        tmp_path = METRICS_PATH.with_suffix('.tmp')
+        tmp_path.write_text(METRICS.render())
+        os.replace(tmp_path, METRICS_PATH)
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx: Context):
+        """Show how long commands, database calls and requests take."""
+        lines = []
+        for metric in METRICS.metrics.values():
+            lines.append(f'# {metric.name}')
+            if isinstance(metric, Histogram):
+                for labels, (counts, sum_) in sorted(metric.values().items()):
+                    count = sum(counts)
+                    labels_str = ' '.join(v for _, v in labels)
+                    lines.append(f'{labels_str}: {count}x, avg {sum_ / count * 1e3:.1f}ms,'
+                                 f' p50 <{metric.quantile(.5, counts) * 1e3:g}ms,'
+                                 f' p95 <{metric.quantile(.95, counts) * 1e3:g}ms')
+            else:
+                for labels, value in sorted(metric.values().items()):
+                    lines.append(f"{' '.join(v for _, v in labels) or 'value'}: {value}")
+        await ctx.send_paginated('\n'.join(lines), prefix='```md\n', suffix='```')
+
+
+def setup(bot: Shinobu):
+    bot.add_cog(Stats(bot))
@@ -1,15 +1,12 @@
 from __future__ import annotations
 
-from contextlib import AsyncExitStack
-
 import nextcord
 from nextcord.ext import commands
 
 from api.expected_errors import ExpectedCommandError
 from api.my_context import Context
 from api.shinobu import Shinobu
-from utils import database
-from utils.trade import Change, CHANGES, require
+from utils.trade import Change, TRADES, require
 
 
 class Trade(commands.Cog):
@@ -22,32 +19,27 @@ class Trade(commands.Cog):
     @require
     async def trade_cancel(self, ctx: Context):
         """Cancel your transaction."""
-        change_list = CHANGES[ctx.author]
-        async with change_list.lock:
-            change_list.clear()
-            await ctx.info(f"Cancelled {ctx.author.mention}'s transaction.")
+        await TRADES.cancel(ctx.bot.db, ctx.author.id)
+        await ctx.info(f"Cancelled {ctx.author.mention}'s transaction.")
 
     @trade.command(name='sign', aliases=['s'])
     @require
     async def trade_sign(self, ctx: Context, *signers: nextcord.User):
         """Execute the transactions of every specified signer including yourself"""
         signers: set[nextcord.User] = {ctx.author, *signers}
-        async with AsyncExitStack() as stack:
-            for s in signers:
-                await stack.enter_async_context(CHANGES[s].lock)
-            all_changes: list[Change] = [c for s in signers for c in CHANGES[s]]
-            changes_str = '\n'.join(str(c) for c in all_changes)
+
+        async def confirm(changes: list[Change]) -> bool:
+            changes_str = '\n'.join(str(c) for c in changes)
             mention_str = ', '.join(s.mention for s in signers)
-            msg = await ctx.send(f"{mention_str}: Do you accept the following changes?\n{changes_str}")
-            if await ctx.confirm(msg, users=signers):
-                with database.connect() as db:
-                    for c in all_changes:
-                        await c.execute(db)
-                    for s in signers:
-                        CHANGES[s].clear()
-                    await ctx.info("Successfully executed transaction.")
-            else:
-                raise ExpectedCommandError("Cancelled execution! (Transaction contents are kept)")
+            confirmation = ctx.confirm_buttons(signers)
+            msg = await ctx.send(f"{mention_str}: Do you accept the following changes?\n{changes_str}",
+                                 view=confirmation)
+            return await confirmation.run(msg)
+
+        if await TRADES.sign(ctx.bot.db, [s.id for s in signers], confirm) is not None:
+            await ctx.info("Successfully executed transaction.")
+        else:
+            raise ExpectedCommandError("Cancelled execution! (Transaction contents are kept)")
 
 
 def setup(bot: Shinobu):
@@ -5,7 +5,7 @@ setup(
     version='1.0.0',
     packages=['api', 'data', 'extensions', 'utils'],
     scripts=['shinobu-bot.py'],
-    python_requires='>=3.9',
+    python_requires='>=3.10',
     install_requires=[
         'aiohttp[speedups]',
         'nextcord',
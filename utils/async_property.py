@@ -1,16 +1,23 @@
-
-
-empty_cache = object()
+def cache_attribute(name: str) -> str:
+    return f'_cached_{name}'
 
 
 def async_cached_property(async_getter):
-    cached = empty_cache
+    # the value is cached on the instance itself so that every instance has its own cache
+    attribute = cache_attribute(async_getter.__name__)
 
     @property
     async def async_property(self):
-        nonlocal cached
-        if cached is empty_cache:
-            cached = await async_getter(self)
-        return cached
+        try:
+            return vars(self)[attribute]
+        except KeyError:
+            value = vars(self)[attribute] = await async_getter(self)
+            return value
 
     return async_property
+
+
+def seed_cached_properties(instance, **values):
+    """Fill the cache of an instance's async_cached_properties with already known values"""
+    for name, value in values.items():
+        vars(instance)[cache_attribute(name)] = value
@@ -6,23 +6,22 @@ from re import Match
 from typing import AnyStr, Optional
 from urllib.parse import quote_plus
 
-import aiohttp
+from utils.http import HttpClient
 
 _BASE_URL = 'https://www.bing.com'
 
 
-async def search(query, session: aiohttp.ClientSession, delay=1):
+async def search(query, client: HttpClient, delay=1):
     url = _BASE_URL + f'/search?q={quote_plus(query)}'
-    async for page in result_pages(session, url):
+    async for page in result_pages(client, url):
         for match in re.finditer(r'<h2>.+?href="(.+?)"', page):
             yield match.group(1)
         await asyncio.sleep(delay)
 
 
-async def result_pages(session: aiohttp.ClientSession, url: str):
+async def result_pages(client: HttpClient, url: str):
     while True:
-        async with session.get(url) as resp:
-            page = await resp.text()
+        page = (await client.get(url)).text()
         yield page
         # Next page of search results
         next_url_match = re.search(r'title="Next page" href="(.+?)"', page)
@@ -0,0 +1,142 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable
+
+from utils.database import DB
+from utils.waifu_search import normalize
+from utils.waifus import catalog_version
+
+
+class TokenIndex:
+    """Inverted index from normalized tokens to positions, stored as a sorted token list and posting arrays"""
+
+    def __init__(self, texts: Iterable[str]):
+        postings: defaultdict[str, array] = defaultdict(lambda: array('I'))
+        for position, text in enumerate(texts):
+            for token in dict.fromkeys(normalize(text)):
+                postings[token].append(position)
+        self.tokens = sorted(postings)
+        self.postings = [postings[t] for t in self.tokens]
+
+    def scores(self, query: str, limit: int) -> dict[int, int]:
+        """Score the positions matching the query: 2 points for every exact token match, 1 for every prefix match.
+
+        Once there are enough candidates, frequent query tokens only add to the scores of existing candidates
+        instead of adding all of their (many) positions, so common words don't make a query scan the catalog.
+        """
+        matches = []
+        for query_token in dict.fromkeys(normalize(query)):
+            token_matches = []
+            i = bisect_left(self.tokens, query_token)
+            while i < len(self.tokens) and self.tokens[i].startswith(query_token):
+                token_matches.append((2 if self.tokens[i] == query_token else 1, self.postings[i]))
+                i += 1
+            matches.append(token_matches)
+        matches.sort(key=lambda token_matches: sum(len(postings) for _, postings in token_matches))
+
+        scores: defaultdict[int, int] = defaultdict(int)
+        for token_matches in matches:
+            if len(scores) >= limit and sum(len(postings) for _, postings in token_matches) > len(scores):
+                for position in scores:
+                    scores[position] += max((points for points, postings in token_matches
+                                             if _contains(postings, position)), default=0)
+                continue
+
+            token_scores: dict[int, int] = {}
+            for points, postings in token_matches:
+                for position in postings:
+                    if token_scores.get(position, 0) < points:
+                        token_scores[position] = points
+            for position, points in token_scores.items():
+                scores[position] += points
+        return scores
+
+
+def _contains(postings: array, position: int) -> bool:
+    # postings are sorted since positions are added in ascending order
+    i = bisect_left(postings, position)
+    return i < len(postings) and postings[i] == position
+
+
+@dataclass(frozen=True)
+class CharacterResult:
+    id: int
+    name: str
+    series: str
+    rarity: str
+    batch: str
+
+
+@dataclass(frozen=True)
+class SeriesResult:
+    name: str
+    characters: int
+    batches: tuple[str, ...]
+
+
+class _Catalog:
+    def __init__(self, db: DB):
+        rows = db.execute('SELECT character.id, character.name, character.series, character.batch,'
+                          ' rarity.name AS rarity FROM character'
+                          ' LEFT JOIN rarity ON rarity.value = character.rarity').fetchall()
+        self.ids = array('q', (r['id'] for r in rows))
+        self.names = [r['name'] for r in rows]
+        self.series_of = [r['series'] for r in rows]
+        self.batches = [r['batch'] for r in rows]
+        self.rarities = [r['rarity'] or '?' for r in rows]
+        self.name_index = TokenIndex(self.names)
+
+        characters_in_series: defaultdict[str, array] = defaultdict(lambda: array('I'))
+        for position, series in enumerate(self.series_of):
+            characters_in_series[series].append(position)
+        self.series = list(characters_in_series)
+        self.series_characters = list(characters_in_series.values())
+        self.series_index = TokenIndex(self.series)
+
+    def character(self, position: int) -> CharacterResult:
+        return CharacterResult(id=self.ids[position], name=self.names[position], series=self.series_of[position],
+                               rarity=self.rarities[position], batch=self.batches[position])
+
+    def search_characters(self, query: str, limit: int) -> list[CharacterResult]:
+        scores = self.name_index.scores(query, limit)
+        best = heapq.nsmallest(limit, scores, key=lambda p: (-scores[p], len(self.names[p]), self.names[p]))
+        return [self.character(p) for p in best]
+
+    def search_series(self, query: str, limit: int) -> list[SeriesResult]:
+        scores = self.series_index.scores(query, limit)
+        best = heapq.nsmallest(limit, scores, key=lambda p: (-scores[p], len(self.series[p]), self.series[p]))
+        return [SeriesResult(name=self.series[p], characters=len(self.series_characters[p]),
+                             batches=tuple(dict.fromkeys(self.batches[c] for c in self.series_characters[p])))
+                for p in best]
+
+
+class CatalogIndex:
+    """Token index of every character's name and series, rebuilt whenever the catalog version changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._catalog = None
+
+    def catalog(self, db: DB) -> _Catalog:
+        version = catalog_version(db)
+        with self._lock:
+            if version == self._version:
+                return self._catalog
+        catalog = _Catalog(db)
+        with self._lock:
+            self._version, self._catalog = version, catalog
+        return catalog
+
+    def search_characters(self, db: DB, query: str, limit: int = 25) -> list[CharacterResult]:
+        return self.catalog(db).search_characters(query, limit)
+
+    def search_series(self, db: DB, query: str, limit: int = 25) -> list[SeriesResult]:
+        return self.catalog(db).search_series(query, limit)
+
+
+CATALOG_INDEX = CatalogIndex()
@@ -1,15 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import sqlite3
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import partial
-from typing import Optional, Union, TypeVar, Any, Final, Iterator, Generator
+from typing import Optional, Union, TypeVar, Any, Final, Iterator, Callable, Iterable, ClassVar, Sequence
 
 import nextcord
 
 from api.expected_errors import ExpectedCommandError
 from data.CONSTANTS import DB_PATH
+from utils.metrics import DB_SECONDS
 
 DB = sqlite3.Connection
 
@@ -20,12 +23,120 @@ def connect(db_path=DB_PATH) -> DB:
     return db
 
 
-def nested_dict() -> defaultdict:
-    return defaultdict(nested_dict)
+# callbacks registered by on_commit during the Database transaction that is running on the current thread
+_commit_callbacks = threading.local()
+
+
+def on_commit(callback: Callable[[], Any]):
+    """Call callback once the current Database transaction has been committed (never if it is rolled back).
+    Outside of Database transactions the callback is called immediately."""
+    callbacks = getattr(_commit_callbacks, 'callbacks', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+class Database:
+    """Asynchronous facade over a small set of long-lived WAL-mode connections.
+
+    Every worker thread owns exactly one connection. Writes are serialized through a single writer thread
+    (so transactions never fight over the write lock), reads are spread over a few reader threads.
+    """
+
+    def __init__(self, db_path=DB_PATH, readers: int = 4, busy_timeout: float = 30):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections: list[DB] = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='db-reader')
+
+    def _connection(self) -> DB:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # isolation_level=None: transactions are managed explicitly in _transaction and _read
+            db = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None,
+                                 check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            with self._connections_lock:
+                self._connections.append(db)
+        return db
+
+    def _transaction(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        _commit_callbacks.callbacks = callbacks = []
+        try:
+            with DB_SECONDS.time(kind='transaction', function=_function_name(func)):
+                result = func(db, *args, **kwargs)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+        finally:
+            _commit_callbacks.callbacks = None
+        for callback in callbacks:
+            callback()
+        return result
+
+    def _read(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        db = self._connection()
+        # a read transaction gives func a consistent snapshot across all of its queries
+        db.execute('BEGIN')
+        try:
+            with DB_SECONDS.time(kind='read', function=_function_name(func)):
+                return func(db, *args, **kwargs)
+        finally:
+            db.execute('ROLLBACK')
+
+    async def transaction(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        """Run func(db, *args, **kwargs) inside a write transaction on the writer thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, partial(self._transaction, func, *args, **kwargs))
+
+    async def read(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        """Run func(db, *args, **kwargs) inside a read-only transaction on a reader thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, partial(self._read, func, *args, **kwargs))
+
+    async def select_one(self, cls: type[_RowDataT], *args, **kwargs) -> Optional[_RowDataT]:
+        return await self.read(cls.select_one, *args, **kwargs)
+
+    async def select_many(self, cls: type[_RowDataT], *args, **kwargs) -> list[_RowDataT]:
+        return await self.read(lambda db: list(cls.select_many(db, *args, **kwargs)))
+
+    async def execute(self, sql: str, parameters: Iterable = ()) -> int:
+        """Execute a single writing statement in its own transaction and return the number of changed rows."""
+        return await self.transaction(lambda db: db.execute(sql, parameters).rowcount)
+
+    async def executemany(self, sql: str, seq_of_parameters: Iterable[Iterable]) -> int:
+        return await self.transaction(lambda db: db.executemany(sql, seq_of_parameters).rowcount)
+
+    def close(self):
+        self._writer.shutdown()
+        self._readers.shutdown()
+        with self._connections_lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
+
+
+def _function_name(func: Callable) -> str:
+    # lambdas and local functions are named after the function they are defined in, to keep the labels few
+    return getattr(func, '__qualname__', type(func).__name__).split('.<locals>')[0]
 
 
 class _Unavailable:
     def __getattribute__(self, name: str):
+        # dataclasses (python >= 3.11) inspect the class of field defaults
+        if name == '__class__':
+            return _Unavailable
         raise AttributeError('Invalid Field Access!')
 
 
@@ -35,53 +146,86 @@ _T = TypeVar('_T')
 NonObligatory = Union[_Unavailable, _T]
 _RowDataT = TypeVar('_RowDataT', bound='RowData')
 
-row_dataclass = partial(dataclass, unsafe_hash=True)
+row_dataclass = partial(dataclass, unsafe_hash=True, slots=True)
+
+RowMapper = Callable[[Sequence], '_RowDataT']
 
 
 @row_dataclass
 class RowData:
-    @classmethod
-    def _get_subclasses(cls) -> Generator[type[_RowDataT], None, None]:
-        for subclass in cls.__subclasses__():
-            yield from subclass._get_subclasses()
-            yield subclass
+    # row classes by lowercase name, used to resolve nested columns like 'character.name'
+    _classes: ClassVar[dict[str, type[RowData]]] = {}
+    # compiled row mappers by (class, column names)
+    _mappers: ClassVar[dict[tuple[type[RowData], tuple[str, ...]], RowMapper]] = {}
 
-    @classmethod
-    def _find_subclass(cls, name: str) -> Optional[type[_RowDataT]]:
-        for subclass in cls._get_subclasses():
-            if subclass.__name__ == name:
-                return subclass
+    def __init_subclass__(cls, **kwargs):
+        super(RowData, cls).__init_subclass__(**kwargs)
+        # dataclass(slots=True) recreates the class, this makes sure the final class is the one that is registered
+        RowData._classes[cls.__name__.lower()] = cls
 
     @classmethod
-    def _from_tree(cls, tree: dict[str, Any]) -> _RowDataT:
-        for key, value in tree.copy().items():
-            if isinstance(value, dict):
-                try:
-                    tree[key] = RowData._find_subclass(key.capitalize())._from_tree(value)
-                except AttributeError:
+    def _compile_mapper(cls, columns: tuple[str, ...]) -> RowMapper:
+        """Generate a function which builds an instance (including nested row data) from a row with these columns"""
+        tree: dict[str, Any] = {}
+        for i, name in enumerate(columns):
+            *subtree_names, field_name = name.split('.')
+            subtree = tree
+            for subtree_name in subtree_names:
+                subtree = subtree.setdefault(subtree_name, {})
+                if not isinstance(subtree, dict):
                     raise ValueError('invalid tree')
-        return cls(**tree)
+            subtree[field_name] = i
+
+        namespace: dict[str, type[RowData]] = {}
+
+        def expression(row_cls: type[RowData], subtree: dict[str, Any]) -> str:
+            namespace[class_name := f'_{row_cls.__name__}_{len(namespace)}'] = row_cls
+            arguments = []
+            for key, value in subtree.items():
+                if not key.isidentifier():
+                    raise ValueError(f'invalid column name: {key!r}')
+                if isinstance(value, dict):
+                    if (nested_cls := RowData._classes.get(key)) is None:
+                        raise ValueError('invalid tree')
+                    arguments.append(f'{key}={expression(nested_cls, value)}')
+                else:
+                    arguments.append(f'{key}=row[{value}]')
+            return f'{class_name}({", ".join(arguments)})'
+
+        source = f'def mapper(row): return {expression(cls, tree)}'
+        exec(source, namespace)
+        return namespace['mapper']
+
+    @classmethod
+    def mapper(cls, columns: tuple[str, ...]) -> RowMapper:
+        try:
+            return RowData._mappers[cls, columns]
+        except KeyError:
+            mapper = RowData._mappers[cls, columns] = cls._compile_mapper(columns)
+            return mapper
 
     @classmethod
     def build(cls, **kwargs) -> _RowDataT:
-        tree: defaultdict[str, Any] = nested_dict()
-        for name, value in kwargs.items():
-            subnames = name.split('.')
-            subtree = tree
-            for subtree_name in subnames[:-1]:
-                subtree = subtree[subtree_name]
-            subtree[subnames[-1]] = value
-        return cls._from_tree(tree)
+        return cls.mapper(tuple(kwargs))(tuple(kwargs.values()))
+
+    @classmethod
+    def _cursor_mapper(cls, cursor: sqlite3.Cursor) -> RowMapper:
+        return cls.mapper(tuple(column[0] for column in cursor.description))
 
     @classmethod
     def select_one(cls, db: DB, *args, **kwargs) -> _RowDataT:
-        if row := db.execute(*args, **kwargs).fetchone():
-            return cls.build(**row)
+        with DB_SECONDS.time(kind='select_one', function=cls.__name__):
+            cursor = db.execute(*args, **kwargs)
+        if row := cursor.fetchone():
+            return cls._cursor_mapper(cursor)(row)
 
     @classmethod
     def select_many(cls, db: DB, *args, **kwargs) -> Iterator[_RowDataT]:
-        for row in db.execute(*args, **kwargs):
-            yield cls.build(**row)
+        with DB_SECONDS.time(kind='select_many', function=cls.__name__):
+            cursor = db.execute(*args, **kwargs)
+        if cursor.description is None:
+            return
+        yield from map(cls._cursor_mapper(cursor), cursor)
 
 
 @row_dataclass
@@ -130,7 +274,8 @@ class Waifu(RowData):
         return embed
 
     def ensure_ownership(self, db: DB):
-        updated_waifu: Waifu = self.select_one(db, 'SELECT * FROM waifu WHERE id=? AND user=?', [self.id, self.user.id])
+        updated_waifu: Waifu = self.select_one(db, 'SELECT id, user, character, rarity FROM waifu WHERE id=? AND user=?',
+                                               [self.id, self.user.id])
         if updated_waifu is None:
             raise ExpectedCommandError(f"You no longer own {self.character.name}!")
         elif (updated_waifu.id != self.id
@@ -0,0 +1,121 @@
+"""The HTTP client used for every outgoing request of the bot, except for Discord's own.
+
+A single aiohttp session keeps connections alive between requests, so scraping a series page right after searching
+for it doesn't cost another TLS handshake. Identical requests in flight at the same time are coalesced into one
+(singleflight), failed requests are retried with jittered exponential backoff.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional, Mapping
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+from utils.metrics import http_trace_config
+from utils.rate_limit import HostRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# responses worth another try, anything else is returned to the caller as it is
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+@dataclass(frozen=True)
+class Response:
+    """A response whose body has been read completely, so that it can be shared by coalesced requests"""
+    status: int
+    headers: CIMultiDictProxy[str]
+    body: bytes
+    encoding: str
+    request_info: aiohttp.RequestInfo
+
+    def text(self) -> str:
+        return self.body.decode(self.encoding, errors='replace')
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(self.request_info, (), status=self.status, headers=self.headers)
+
+
+class HttpClient:
+    def __init__(self, limit_per_host: int, timeout: timedelta, retries: int, backoff: timedelta,
+                 rate_limiter: Optional[HostRateLimiter] = None):
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        # 'created' and 'reused' connections
+        self.connections: Counter[str] = Counter()
+        # 'sent' (including retries), 'retried' and 'coalesced' requests
+        self.requests: Counter[str] = Counter()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created on first use, aiohttp sessions have to be created inside the event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout.total_seconds()),
+                trace_configs=[http_trace_config(), self._pool_trace_config()])
+        return self._session
+
+    def _pool_trace_config(self) -> aiohttp.TraceConfig:
+        async def on_connection_create_end(*_):
+            self.connections['created'] += 1
+
+        async def on_connection_reuseconn(*_):
+            self.connections['reused'] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> Response:
+        return await self.request('GET', url, headers)
+
+    async def request(self, method: str, url: str, headers: Optional[Mapping[str, str]] = None) -> Response:
+        """Send a request, sharing the response with identical requests which are in flight already"""
+        key = method, url, tuple(sorted((headers or {}).items()))
+        if (task := self._in_flight.get(key)) is not None:
+            self.requests['coalesced'] += 1
+        else:
+            task = self._in_flight[key] = asyncio.create_task(self._request(method, url, headers))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # a cancelled caller mustn't cancel the request for the others waiting for it
+        return await asyncio.shield(task)
+
+    async def _request(self, method: str, url: str, headers: Optional[Mapping[str, str]]) -> Response:
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.requests['retried'] += 1
+                # full jitter, so that requests which failed together don't retry together
+                await asyncio.sleep(random.uniform(0, self.backoff.total_seconds() * 2 ** (attempt - 1)))
+            if self.rate_limiter is not None:
+                await self.rate_limiter.wait(url)
+            self.requests['sent'] += 1
+            try:
+                async with self.session.request(method, url, headers=headers) as resp:
+                    response = Response(status=resp.status, headers=resp.headers, body=await resp.read(),
+                                        encoding=resp.get_encoding(), request_info=resp.request_info)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.debug(f'{method} {url} failed ({e!r}), retrying')
+                continue
+            if response.status not in RETRY_STATUSES or attempt == self.retries:
+                return response
+            logger.debug(f'{method} {url} returned {response.status}, retrying')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,102 @@
+"""Checks of the characters' image urls, so that dead images are dropped from embeds instead of showing up broken.
+
+The results are kept in the image_check table. The queries loading characters for embeds join it and drop image
+urls known to be dead, and turning an image dead (or alive again) bumps the image version, which invalidates the
+pack samplers (see utils.migrations and utils.waifus.samplers_version).
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+import aiohttp
+
+from utils.database import DB, Database
+from utils.http import HttpClient, Response
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ImageCheck:
+    url: str
+    # None if the server couldn't be reached at all
+    status: Optional[int]
+    content_type: Optional[str]
+    size: Optional[int]
+    checked_at: float
+
+    @property
+    def ok(self) -> bool:
+        return (self.status is not None and 200 <= self.status < 300
+                and self.content_type is not None and self.content_type.startswith('image/'))
+
+
+def _size(response: Response) -> Optional[int]:
+    # a ranged GET tells the size in Content-Range (bytes 0-0/12345), a HEAD in Content-Length
+    if match := re.fullmatch(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', '')):
+        return int(match.group(1))
+    if response.status == 200 and (length := response.headers.get('Content-Length', '')).isdigit():
+        return int(length)
+
+
+async def check_image(client: HttpClient, url: str) -> ImageCheck:
+    try:
+        response = await client.request('HEAD', url)
+        if response.status >= 400:
+            # some servers refuse HEAD requests, the first byte is enough to know if the image is there
+            response = await client.request('GET', url, headers={'Range': 'bytes=0-0'})
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f'checking {url} failed: {e!r}')
+        return ImageCheck(url=url, status=None, content_type=None, size=None, checked_at=time.time())
+    return ImageCheck(url=url, status=response.status, content_type=response.headers.get('Content-Type'),
+                      size=_size(response), checked_at=time.time())
+
+
+def image_urls_to_check(db: DB, checked_before: float, after_id: int, limit: int) -> list[tuple[int, str]]:
+    """Get (character id, image url) of the next characters after after_id whose image hasn't been checked since"""
+    return db.execute("""
+    SELECT character.id, character.image_url
+    FROM character
+    LEFT JOIN image_check ON image_check.url = character.image_url
+    WHERE character.id > ? AND character.image_url IS NOT NULL
+    AND (image_check.checked_at IS NULL OR image_check.checked_at < ?)
+    ORDER BY character.id
+    LIMIT ?
+    """, [after_id, checked_before, limit]).fetchall()
+
+
+def save_image_checks(db: DB, checks: list[ImageCheck]):
+    # an upsert rather than REPLACE, the image version triggers only fire on updates that change ok
+    db.executemany("""
+    INSERT INTO image_check(url, status, content_type, size, ok, checked_at) VALUES(?,?,?,?,?,?)
+    ON CONFLICT(url) DO UPDATE SET
+        status=excluded.status, content_type=excluded.content_type, size=excluded.size, ok=excluded.ok,
+        checked_at=excluded.checked_at
+    """, [(c.url, c.status, c.content_type, c.size, c.ok, c.checked_at) for c in checks])
+
+
+async def check_catalog_images(db: Database, client: HttpClient, max_age: timedelta, concurrency: int,
+                               chunk_size: int = 1000) -> Counter[str]:
+    """Check the image urls of the catalog that haven't been checked within max_age, at most concurrency at once.
+    Returns the number of 'ok' and 'dead' images."""
+    checked_before = time.time() - max_age.total_seconds()
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = Counter()
+
+    async def check(url: str) -> ImageCheck:
+        async with semaphore:
+            return await check_image(client, url)
+
+    after_id = -2 ** 63
+    while rows := await db.read(image_urls_to_check, checked_before, after_id, chunk_size):
+        after_id = rows[-1][0]
+        checks = await asyncio.gather(*map(check, dict.fromkeys(url for _, url in rows)))
+        await db.transaction(save_image_checks, checks)
+        counts.update('ok' if c.ok else 'dead' for c in checks)
+        logger.info(f'checked {sum(counts.values())} images, {counts["dead"]} dead')
+    return counts
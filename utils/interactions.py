@@ -1,27 +1,40 @@
 import nextcord
 from nextcord.ext import commands
 
+from api.button_menu import ButtonMenu
 from api.expected_errors import ExpectedCommandError
 from api.my_context import Context
 from data.CONSTANTS import CURRENCY, UPGRADE, TRASH, SEND, CONFIRM, CANCEL
 from extensions.trade import Trade
-from utils.database import DB, Waifu, Rarity
-from utils.trade import add_money, WaifuTransfer, CHANGES, MoneyTransfer
+from utils.database import DB, Database, Waifu, Rarity, on_commit
+from utils.trade import add_money, Change, WaifuTransfer, TRADES, MoneyTransfer
+from utils.waifu_search import WAIFU_INDEX
 
 
-async def waifu_interactions(ctx: Context, db: DB, msg: nextcord.Message, waifu: Waifu):
+def waifu_buttons(ctx: Context, db: Database, waifu: Waifu) -> ButtonMenu:
     # TODO: allow interactions that ctx.author can't react to
     assert waifu.user.id == ctx.author.id
 
+    def refund_waifu(db_: DB, user_id: int):
+        waifu.ensure_ownership(db_)
+        add_money(db_, user_id, waifu.rarity.refund)
+        db_.execute('DELETE FROM waifu WHERE id=?', [waifu.id])
+        on_commit(lambda: WAIFU_INDEX.remove(user_id, waifu.id))
+
+    def upgrade_waifu(db_: DB, user_id: int) -> Rarity:
+        waifu.ensure_ownership(db_)
+        new_rarity = Rarity.select_one(db_, 'SELECT * FROM rarity WHERE value=?', [waifu.rarity.value + 1])
+        add_money(db_, user_id, -waifu.rarity.upgrade_cost)
+        db_.execute('UPDATE waifu SET rarity=? WHERE id=?', [new_rarity.value, waifu.id])
+        return new_rarity
+
     async def trash(user: nextcord.User, **_):
-        waifu.ensure_ownership(db)
+        await db.read(waifu.ensure_ownership)
+        confirmation = ctx.confirm_buttons()
         confirmation_msg = await ctx.info(f'Do you really want to refund {waifu.character.name}'
-                                          f' for {waifu.rarity.refund} {CURRENCY}?')
-        if await ctx.confirm(confirmation_msg):
-            waifu.ensure_ownership(db)
-            with db:
-                add_money(db, user.id, waifu.rarity.refund)
-                db.execute('DELETE FROM waifu WHERE id=?', [waifu.id])
+                                          f' for {waifu.rarity.refund} {CURRENCY}?', view=confirmation)
+        if await confirmation.run(confirmation_msg):
+            await db.transaction(refund_waifu, user.id)
             embed: nextcord.Embed = confirmation_msg.embeds[0]
             embed.description = f"Successfully refunded {waifu.character.name} for {waifu.rarity.refund} {CURRENCY}"
             await confirmation_msg.edit(embed=embed)
@@ -29,15 +42,12 @@ async def waifu_interactions(ctx: Context, db: DB, msg: nextcord.Message, waifu:
             await confirmation_msg.delete()
 
     async def upgrade(user: nextcord.User, **_):
-        waifu.ensure_ownership(db)
+        await db.read(waifu.ensure_ownership)
+        confirmation = ctx.confirm_buttons()
         confirmation_msg = await ctx.info(f'Do you really want to upgrade {waifu.character.name}'
-                                          f' for {waifu.rarity.upgrade_cost} {CURRENCY}?')
-        if await ctx.confirm(confirmation_msg):
-            waifu.ensure_ownership(db)
-            new_rarity = Rarity.select_one(db, 'SELECT * FROM rarity WHERE value=?', [waifu.rarity.value + 1])
-            with db:
-                add_money(db, user.id, -waifu.rarity.upgrade_cost)
-                db.execute('UPDATE waifu SET rarity=? WHERE id=?', [new_rarity.value, waifu.id])
+                                          f' for {waifu.rarity.upgrade_cost} {CURRENCY}?', view=confirmation)
+        if await confirmation.run(confirmation_msg):
+            new_rarity = await db.transaction(upgrade_waifu, user.id)
             embed: nextcord.Embed = confirmation_msg.embeds[0]
             embed.description = f"Successfully upgraded {waifu.character.name} to a **{new_rarity.name}**"
             await confirmation_msg.edit(embed=embed)
@@ -45,7 +55,7 @@ async def waifu_interactions(ctx: Context, db: DB, msg: nextcord.Message, waifu:
             await confirmation_msg.delete()
 
     async def send(user: nextcord.User, **_):
-        waifu.ensure_ownership(db)
+        await db.read(waifu.ensure_ownership)
 
         answer = await ctx.quick_question(f'Who do you want to give {waifu.character.name} to?', user)
         if answer is None:
@@ -57,23 +67,19 @@ async def waifu_interactions(ctx: Context, db: DB, msg: nextcord.Message, waifu:
             raise ExpectedCommandError(f"Invalid user! You have to mention them like so: {ctx.bot.user.mention}")
 
         transfer = WaifuTransfer(from_id=user.id, to_id=trade_to.id, waifu=waifu)
-        change_list = CHANGES[ctx.author]
-        async with change_list.lock:
-            waifu.ensure_ownership(db)
-            change_list.append(transfer)
-        queued_msg = await ctx.info(f"Queued action: {transfer}")
-        await queue_interactions(ctx, queued_msg)
-
-    reactions = {}
+        await TRADES.queue(db, ctx.author.id, transfer)
+        await send_queued(ctx, transfer)
+
+    buttons = {}
     if waifu.rarity.upgrade_cost is not None:
-        reactions[UPGRADE] = upgrade
-    reactions[TRASH] = trash
-    reactions[SEND] = send
+        buttons[UPGRADE] = upgrade
+    buttons[TRASH] = trash
+    buttons[SEND] = send
 
-    await ctx.reaction_buttons(msg, reactions)
+    return ctx.button_menu(buttons)
 
 
-async def user_interactions(ctx: Context, msg: nextcord.Message, target_user: nextcord.User):
+def user_buttons(ctx: Context, target_user: nextcord.User) -> ButtonMenu:
     async def send(user: nextcord.User, **_):
         if user == target_user:
             answer = await ctx.quick_question(f'Who do you want to give {CURRENCY} to?', user)
@@ -97,16 +103,14 @@ async def user_interactions(ctx: Context, msg: nextcord.Message, target_user: ne
             raise ExpectedCommandError(f"Invalid amount!")
 
         transfer = MoneyTransfer(from_id=user.id, to_id=trade_to.id, amount=amount)
-        change_list = CHANGES[ctx.author]
-        async with change_list.lock:
-            change_list.append(transfer)
-        queued_msg = await ctx.info(f"Queued action: {transfer}")
-        await queue_interactions(ctx, queued_msg)
+        await TRADES.queue(ctx.bot.db, ctx.author.id, transfer)
+        await send_queued(ctx, transfer)
 
-    await ctx.reaction_buttons(msg, {SEND: send})
+    return ctx.button_menu({SEND: send})
 
 
-async def queue_interactions(ctx: Context, msg: nextcord.Message):
+async def send_queued(ctx: Context, change: Change):
+    """Tell the author that the change was queued and let them sign or cancel their queue right away"""
     async def confirm(**_):
         # XXX: this is hacky because I'm injecting an incorrect context and self but it doesn't really matter
         await Trade.trade_sign.callback(object(), ctx)
@@ -115,4 +119,5 @@ async def queue_interactions(ctx: Context, msg: nextcord.Message):
         # XXX: this is hacky because I'm injecting an incorrect context and self but it doesn't really matter
         await Trade.trade_cancel.callback(object(), ctx)
 
-    await ctx.reaction_buttons(msg, {CONFIRM: confirm, CANCEL: cancel})
+    menu = ctx.button_menu({CONFIRM: confirm, CANCEL: cancel})
+    await menu.run(await ctx.info(f"Queued action: {change}", view=menu))
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from typing import Optional, TypeVar, Callable, Awaitable
+
+from utils.async_property import seed_cached_properties
+from utils.database import DB, Database, RowData, row_dataclass
+from utils.http import HttpClient
+from utils.mal_scraper import Content
+from utils.mal_titles import add_mal_titles
+
+logger = logging.getLogger(__name__)
+
+_ContentT = TypeVar('_ContentT', bound=Content)
+
+METADATA_QUERY = 'SELECT * FROM mal_metadata WHERE type=? AND id=?'
+SEARCH_QUERY = 'SELECT id, searched_at FROM mal_search WHERE type=? AND query=?'
+
+
+@row_dataclass
+class MalMetadata(RowData):
+    type: str
+    id: int
+    fetched_at: float
+    title: Optional[str] = None
+    thumbnail: Optional[str] = None
+    score: Optional[float] = None
+    status: Optional[str] = None
+    duration: Optional[int] = None
+    volumes: Optional[int] = None
+    chapters: Optional[int] = None
+
+    def properties(self, content_type: type[Content]) -> dict:
+        values = {field: getattr(self, field) for field in content_type.metadata_fields}
+        if 'duration' in values and values['duration'] is not None:
+            values['duration'] = timedelta(seconds=values['duration'])
+        return values
+
+
+def _column_value(value):
+    if isinstance(value, timedelta):
+        return int(value.total_seconds())
+    return value
+
+
+def _store_metadata(db: DB, domain_suffix: str, id_: int, values: dict, titles: list[str]):
+    columns = ('type', 'id', 'fetched_at', *values)
+    db.execute(f'REPLACE INTO mal_metadata({", ".join(columns)}) VALUES({", ".join("?" * len(columns))})',
+               [domain_suffix, id_, time.time(), *values.values()])
+    add_mal_titles(db, [(domain_suffix, id_, title) for title in titles])
+
+
+class MalMetadataCache:
+    """Persistent cache of the metadata scraped from myanimelist.net series pages.
+
+    Entries younger than ttl are used as they are. Entries younger than max_staleness are used as well, but they
+    are refreshed in the background (stale-while-revalidate). Anything older is scraped before returning.
+    """
+
+    def __init__(self, db: Database, client: HttpClient, ttl: timedelta, max_staleness: timedelta):
+        self.db = db
+        self.client = client
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        self._refreshing: dict[tuple[str, int], asyncio.Task] = {}
+
+    async def get(self, content_type: type[_ContentT], id_: int) -> _ContentT:
+        """Get a scraper whose metadata properties are already filled in from the cache if possible"""
+        metadata = await self.db.select_one(MalMetadata, METADATA_QUERY, [content_type.domain_suffix, id_])
+        # rows without a title were cached from error pages before they were refused
+        if metadata is None or metadata.title is None:
+            return await self.refresh(content_type, id_)
+
+        age = time.time() - metadata.fetched_at
+        if age > self.max_staleness.total_seconds():
+            return await self.refresh(content_type, id_)
+        if age > self.ttl.total_seconds():
+            self._refresh_in_background(content_type, id_)
+
+        content = content_type.from_id(id_, self.client)
+        seed_cached_properties(content, **metadata.properties(content_type))
+        return content
+
+    async def refresh(self, content_type: type[_ContentT], id_: int) -> _ContentT:
+        """Scrape the series page and store its metadata and titles"""
+        content = content_type.from_id(id_, self.client)
+        values = {field: _column_value(await getattr(content, field)) for field in content_type.metadata_fields}
+        if values['title'] is None:
+            # not a series page after all, the previous row (if any) is better than nothing
+            raise ValueError(f"{content.url} doesn't look like a series page, its metadata isn't cached")
+        titles = [values['title'], *await content.alternative_titles]
+        await self.db.transaction(_store_metadata, content_type.domain_suffix, id_, values, titles)
+        return content
+
+    def _refresh_in_background(self, content_type: type[Content], id_: int):
+        key = content_type.domain_suffix, id_
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self.refresh(content_type, id_)
+            except Exception:
+                logger.exception(f'failed to refresh the metadata of {content_type.domain_suffix} {id_}')
+            finally:
+                del self._refreshing[key]
+
+        self._refreshing[key] = asyncio.create_task(refresh())
+
+
+class MalSearchCache:
+    """Cache of search query -> MAL id, kept in the mal_search table with a small LRU cache in front of it.
+
+    Queries without results are cached as well, but for a shorter time (negative_ttl).
+    """
+
+    def __init__(self, db: Database, ttl: timedelta, negative_ttl: timedelta, size: int = 1024):
+        self.db = db
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self._lru: OrderedDict[tuple[str, str], tuple[Optional[int], float]] = OrderedDict()
+        # 'memory' and 'database' hits, and 'misses'
+        self.stats: Counter[str] = Counter()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return ' '.join(re.findall(r'\w+', query.casefold()))
+
+    def _is_fresh(self, id_: Optional[int], searched_at: float) -> bool:
+        ttl = self.ttl if id_ is not None else self.negative_ttl
+        return time.time() - searched_at < ttl.total_seconds()
+
+    def _remember(self, key: tuple[str, str], id_: Optional[int], searched_at: float):
+        self._lru[key] = id_, searched_at
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    async def get(self, domain_suffix: str, query: str,
+                  search: Callable[[str, str], Awaitable[Optional[int]]]) -> Optional[int]:
+        """Get the MAL id for the query, only calling search(domain_suffix, query) if it isn't cached"""
+        key = domain_suffix, self.normalize(query)
+
+        if (cached := self._lru.get(key)) is not None and self._is_fresh(*cached):
+            self._lru.move_to_end(key)
+            self.stats['memory'] += 1
+            return cached[0]
+
+        row = await self.db.read(lambda db: db.execute(SEARCH_QUERY, key).fetchone())
+        if row is not None and self._is_fresh(*row):
+            self._remember(key, *row)
+            self.stats['database'] += 1
+            return row[0]
+
+        self.stats['misses'] += 1
+        id_ = await search(domain_suffix, query)
+        searched_at = time.time()
+        await self.db.execute('REPLACE INTO mal_search(type, query, id, searched_at) VALUES(?,?,?,?)',
+                              [*key, id_, searched_at])
+        self._remember(key, id_, searched_at)
+        return id_
@@ -1,34 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
 import re
-from typing import Iterator
+from typing import Iterator, Optional
 
-import aiohttp
 import feedparser
 
-from utils.database import DB
+from utils.database import DB, Database, RowData, row_dataclass
+from utils.http import HttpClient
 from utils.mal_scraper import Content
 
+FEEDS_QUERY = 'SELECT * FROM mal_feed WHERE user=?'
+CONSUMED_QUERY = 'SELECT id, amount FROM consumed_media WHERE type=? AND user=?'
+
+
+@row_dataclass
+class MalFeed(RowData):
+    """Validators of the last version of a feed whose content has been rewarded"""
+    user: int
+    rss_type: str
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_hash: Optional[str] = None
+
+    def is_for(self, url: str) -> bool:
+        # the validators are useless if the user changed their mal username
+        return self.url == url
+
+
+def save_mal_feeds(db: DB, feeds: list[MalFeed]):
+    db.executemany('REPLACE INTO mal_feed(user, rss_type, url, etag, last_modified, content_hash)'
+                   ' VALUES(?,?,?,?,?,?)',
+                   [(f.user, f.rss_type, f.url, f.etag, f.last_modified, f.content_hash) for f in feeds])
+
+
+async def new_mal_content(db: Database, client: HttpClient, content_type: type[Content], user_id: int,
+                          mal_username: str
+                          ) -> tuple[Iterator[tuple[int, int, int]], list[MalFeed], list[tuple[str, int, str]]]:
+    """Get the new (series id, old amount, consumed amount) entries of a user's feeds,
+    and the (type, series id, title) of every series in them (see utils.mal_titles).
+
+    Feeds which haven't changed since their last rewarded version are skipped (conditional GET with the stored
+    ETag/Last-Modified validators, or a hash of the content if the server didn't send any).
+    The returned validators should be saved with save_mal_feeds once the new content has been rewarded.
+    """
+    old_feeds = {f.rss_type: f for f in await db.select_many(MalFeed, FEEDS_QUERY, [user_id])}
+
+    async def fetch_feed(rss_type: str) -> tuple[list, Optional[MalFeed]]:
+        url = f"https://myanimelist.net/rss.php?type={rss_type}&u={mal_username}"
+        old_feed = old_feeds.get(rss_type)
+        if old_feed is not None and not old_feed.is_for(url):
+            old_feed = None
+
+        headers = {}
+        if old_feed is not None and old_feed.etag:
+            headers['If-None-Match'] = old_feed.etag
+        if old_feed is not None and old_feed.last_modified:
+            headers['If-Modified-Since'] = old_feed.last_modified
+
+        resp = await client.get(url, headers=headers)
+        if resp.status == 304:
+            return [], None
+        resp.raise_for_status()
+        body = resp.body
+        new_feed = MalFeed(user=user_id, rss_type=rss_type, url=url, etag=resp.headers.get('ETag'),
+                           last_modified=resp.headers.get('Last-Modified'),
+                           content_hash=hashlib.sha256(body).hexdigest())
+
+        if old_feed is not None and old_feed.content_hash == new_feed.content_hash:
+            return [], new_feed
+        return feedparser.parse(body).entries, new_feed
 
-async def new_mal_content(db: DB, session: aiohttp.ClientSession, content_type: type[Content], user_id: int,
-                          mal_username: str) -> Iterator[tuple[int, int, int]]:
     entries = []
-    for rss_type in content_type.rss_types:
-        async with session.get(f"https://myanimelist.net/rss.php?type={rss_type}&u={mal_username}") as resp:
-            feed = feedparser.parse(await resp.text())
-            entries.extend(feed.entries)
+    new_feeds = []
+    for feed_entries, new_feed in await asyncio.gather(*map(fetch_feed, content_type.rss_types)):
+        entries.extend(feed_entries)
+        if new_feed is not None:
+            new_feeds.append(new_feed)
+
+    if not entries:
+        return iter(()), new_feeds, []
+
+    def series_id(item) -> int:
+        return int(re.match(rf'https://myanimelist\.net/{content_type.domain_suffix}/(\d+)/.*', item.link).group(1))
+
+    titles = [(content_type.domain_suffix, series_id(item), item.get('title')) for item in entries]
 
-    already_rewarded = dict(db.execute('SELECT id, amount FROM consumed_media WHERE type=? AND user=?',
-                                       [content_type.domain_suffix, user_id]))
+    already_rewarded = dict(await db.read(
+        lambda db_: db_.execute(CONSUMED_QUERY, [content_type.domain_suffix, user_id]).fetchall()))
 
     # only yield from inside the generator closure to avoid having to use an async generator
     def new_content_generator():
-        for item in entries:
-            series_match = re.match(rf'https://myanimelist\.net/{content_type.domain_suffix}/(\d+)/.*', item.link)
-            series_id = int(series_match.group(1))
+        for (_, id_, _), item in zip(titles, entries):
             consumed_match = content_type.consumed_regex.match(item.description)
             consumed_amount = int(consumed_match.group(1))
-            old_amount = already_rewarded.get(series_id, 0)
+            old_amount = already_rewarded.get(id_, 0)
             if old_amount < consumed_amount:
-                already_rewarded[series_id] = consumed_amount
-                yield series_id, old_amount, consumed_amount
+                already_rewarded[id_] = consumed_amount
+                yield id_, old_amount, consumed_amount
 
-    return new_content_generator()
+    return new_content_generator(), new_feeds, titles
@@ -4,31 +4,38 @@ import re
 from abc import abstractmethod
 from datetime import timedelta
 from re import Pattern
-from typing import Optional, Union, Protocol, ClassVar, TypeVar, Iterable
+from typing import Optional, Protocol, ClassVar, TypeVar, Iterable
 
-import aiohttp
 import nextcord
+
+from data.CONSTANTS import HOST_RATE_LIMITS
 from utils.async_property import async_cached_property
+from utils.http import HttpClient
+from utils.mal_page import SeriesPage, parse_series_page
+from utils.metrics import METRICS
+from utils.rate_limit import HostRateLimiter
+
+# shared by every request to myanimelist.net, the bot's HttpClient waits on it
+RATE_LIMITER = HostRateLimiter(HOST_RATE_LIMITS)
+METRICS.collect('shinobu_rate_limited_requests_total', 'Requests that went through the rate limiter, by host',
+                lambda: RATE_LIMITER.requests, label='host', type_='counter')
 
 
 class BaseScraper:
-    def __init__(self, url: str):
+    def __init__(self, url: str, client: HttpClient):
         self.url = url
+        self.client = client
 
     @async_cached_property
     async def page(self) -> str:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url) as response:
-                return await response.text()
+        response = await self.client.get(self.url)
+        # error pages (404, 429 after the retries, 5xx) mustn't be parsed as series pages
+        response.raise_for_status()
+        return response.text()
 
-    async def _safe_single_match(self, pattern, **kwargs) -> Union[str, tuple[str, ...], None]:
-        matches = re.findall(pattern, await self.page, **kwargs)
-        length = len(matches)
-        if length == 1:
-            return matches[0]
-        if length > 1:
-            raise ValueError(
-                f"Found multiple matches for '{pattern}' on {self.url}: {matches}")
+    @async_cached_property
+    async def parsed(self) -> SeriesPage:
+        return parse_series_page(await self.page, self.url)
 
 
 _ContentT = TypeVar('_ContentT', bound='Content')
@@ -38,10 +45,12 @@ class Content(Protocol):
     domain_suffix: ClassVar[str]
     rss_types: ClassVar[Iterable[str]]
     consumed_regex: ClassVar[Pattern]
+    # names of the async_cached_properties worth caching persistently (see utils.mal_cache)
+    metadata_fields: ClassVar[tuple[str, ...]]
 
     @classmethod
     @abstractmethod
-    def from_id(cls, id_: int) -> _ContentT: raise NotImplementedError
+    def from_id(cls, id_: int, client: HttpClient) -> _ContentT: raise NotImplementedError
 
     @abstractmethod
     async def to_embed(self) -> nextcord.Embed: raise NotImplementedError
@@ -52,6 +61,8 @@ class Content(Protocol):
 
 
 class _AnimeMangaAgnosticScraper(BaseScraper):
+    metadata_fields = ('title', 'thumbnail', 'score', 'status')
+
     async def to_embed(self) -> nextcord.Embed:
         embed = nextcord.Embed()
         embed.colour = nextcord.Colour.dark_blue()
@@ -66,47 +77,48 @@ class _AnimeMangaAgnosticScraper(BaseScraper):
 
     @async_cached_property
     async def title(self) -> str:
-        return await self._safe_single_match(r'<span(?=.*itemprop="name").*>(.+?)</span>')
+        return (await self.parsed).title
+
+    @async_cached_property
+    async def alternative_titles(self) -> tuple[str, ...]:
+        return (await self.parsed).alternative_titles
 
     @async_cached_property
     async def thumbnail(self) -> Optional[str]:
-        return await self._safe_single_match(rf'<img(?=.*alt="{await self.title}").*src="(.+?)".*>')
+        return (await self.parsed).thumbnail
 
     @async_cached_property
     async def score(self) -> Optional[float]:
-        if match := await self._safe_single_match(r'<div(?=.*class="score-label).*>(\d\.\d\d)</div>'):
-            return float(match)
+        return (await self.parsed).score
 
     @async_cached_property
     async def status(self) -> Optional[str]:
-        return await self._safe_single_match(r'<span.*?>Status:</span>\s*(.+?)\s*<')
+        return (await self.parsed).status
 
 
 class Anime(_AnimeMangaAgnosticScraper, Content):
     domain_suffix = 'anime'
     rss_types = {'rwe', 'rw'}
     consumed_regex = re.compile(r'.*- (\d+) of .* episodes')
+    metadata_fields = (*_AnimeMangaAgnosticScraper.metadata_fields, 'duration')
 
     @classmethod
-    def from_id(cls, id_) -> Anime:
-        return cls(f"https://myanimelist.net/anime/{id_}")
+    def from_id(cls, id_, client) -> Anime:
+        return cls(f"https://myanimelist.net/anime/{id_}", client)
 
     async def calculate_reward(self, amount: int) -> int:
         return ((await self.duration).seconds * amount) // 300
 
     @async_cached_property
     async def duration(self) -> Optional[timedelta]:
-        if match := await self._safe_single_match(r'<span.*?>Duration:</span>\s*(?:(\d+) hr.)?\s*(?:(\d+) min.)?'):
-            hours, minutes = match
-            hours = int(hours) if hours else 0
-            minutes = int(minutes) if minutes else 0
-            return timedelta(hours=hours, minutes=minutes)
+        return (await self.parsed).duration
 
 
 class Manga(_AnimeMangaAgnosticScraper, Content):
     domain_suffix = 'manga'
     rss_types = {'rrm', 'rm'}
     consumed_regex = re.compile(r'.*- (\d+) of .* chapters')
+    metadata_fields = (*_AnimeMangaAgnosticScraper.metadata_fields, 'volumes', 'chapters')
 
     async def to_embed(self) -> nextcord.Embed:
         embed = await super().to_embed()
@@ -117,8 +129,8 @@ class Manga(_AnimeMangaAgnosticScraper, Content):
         return embed
 
     @classmethod
-    def from_id(cls, id_) -> Manga:
-        return cls(f"https://myanimelist.net/manga/{id_}")
+    def from_id(cls, id_, client) -> Manga:
+        return cls(f"https://myanimelist.net/manga/{id_}", client)
 
     async def calculate_reward(self, amount: int) -> int:
         # 5 minutes are rewarded for each chapter.
@@ -128,12 +140,8 @@ class Manga(_AnimeMangaAgnosticScraper, Content):
 
     @async_cached_property
     async def volumes(self) -> Optional[int]:
-        match = await self._safe_single_match(r'<span.*?>Volumes:</span>\s*(.+?)\s')
-        if match and match != 'Unknown':
-            return int(match)
+        return (await self.parsed).volumes
 
     @async_cached_property
     async def chapters(self) -> Optional[int]:
-        match = await self._safe_single_match(r'<span.*?>Chapters:</span>\s*(.+?)\s')
-        if match and match != 'Unknown':
-            return int(match)
+        return (await self.parsed).chapters
@@ -0,0 +1,95 @@
+"""Local index of the titles of myanimelist.net series, so that searching for a known series needs no web search.
+
+Titles are learned from the entries of the users' feeds (see extensions.economy) and from every scraped series page
+(see utils.mal_cache), the main title as well as the alternative ones.
+"""
+import heapq
+import threading
+from array import array
+from collections import Counter
+from typing import Iterable, Optional
+
+from fuzzywuzzy import fuzz
+
+from utils.catalog_search import TokenIndex
+from utils.database import DB, on_commit
+from utils.waifu_search import normalize
+
+# how many of the titles sharing the most tokens with a query are scored with the fuzzy matcher
+CANDIDATES = 32
+# queries which aren't a prefix of a title's words need to be this similar to it (typos)
+MIN_FUZZY_SCORE = 90
+# shorter words of a query aren't matched as prefixes, 'o' would find One Piece
+MIN_PREFIX_LENGTH = 3
+
+
+def add_mal_titles(db: DB, titles: Iterable[tuple[str, int, str]]):
+    """Remember (type, id, title) triples, the index picks them up once the transaction is committed"""
+    if db.executemany('INSERT OR IGNORE INTO mal_title(type, id, title) VALUES(?,?,?)',
+                      [(type_, id_, title) for type_, id_, title in titles if title]).rowcount:
+        on_commit(MAL_TITLE_INDEX.invalidate)
+
+
+def _is_prefix_match(query_tokens: list[str], title: str) -> bool:
+    if any(len(q) < MIN_PREFIX_LENGTH for q in query_tokens):
+        return False
+    title_tokens = normalize(title)
+    return all(any(t.startswith(q) for t in title_tokens) for q in query_tokens)
+
+
+class _Titles:
+    def __init__(self, rows: list[tuple[int, str]]):
+        self.ids = array('q', (id_ for id_, _ in rows))
+        self.titles = [title for _, title in rows]
+        self.index = TokenIndex(self.titles)
+
+    def lookup(self, query: str) -> Optional[int]:
+        query_tokens = normalize(query)
+        if not query_tokens:
+            return None
+        scores = self.index.scores(query, CANDIDATES)
+        candidates = heapq.nlargest(CANDIDATES, scores, key=scores.__getitem__)
+        matches = [(fuzz.token_sort_ratio(query, self.titles[p]), p) for p in candidates]
+        matches = [(score, p) for score, p in matches
+                   if score >= MIN_FUZZY_SCORE or _is_prefix_match(query_tokens, self.titles[p])]
+        if not matches:
+            return None
+        # the most similar title wins, 'bebop' is rather Cowboy Bebop than Cowboy Bebop: Tengoku no Tobira
+        _, best = min(matches, key=lambda score_and_p: (-score_and_p[0], len(self.titles[score_and_p[1]])))
+        return self.ids[best]
+
+
+class MalTitleIndex:
+    """Token indexes of the known titles per content type, rebuilt on the next lookup after titles were added"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        # content type -> (generation, titles)
+        self._titles: dict[str, tuple[int, _Titles]] = {}
+        # 'hits' and 'misses'
+        self.stats: Counter[str] = Counter()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+
+    def _titles_of(self, db: DB, domain_suffix: str) -> _Titles:
+        with self._lock:
+            generation = self._generation
+            if (cached := self._titles.get(domain_suffix)) is not None and cached[0] == generation:
+                return cached[1]
+        titles = _Titles(db.execute('SELECT id, title FROM mal_title WHERE type=?', [domain_suffix]).fetchall())
+        with self._lock:
+            self._titles[domain_suffix] = generation, titles
+        return titles
+
+    def lookup(self, db: DB, domain_suffix: str, query: str) -> Optional[int]:
+        """Get the id of the known series whose title best matches the query, if any matches well enough"""
+        id_ = self._titles_of(db, domain_suffix).lookup(query)
+        with self._lock:
+            self.stats['hits' if id_ is not None else 'misses'] += 1
+        return id_
+
+
+MAL_TITLE_INDEX = MalTitleIndex()
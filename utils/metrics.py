@@ -0,0 +1,152 @@
+"""Counters and histograms of what the bot spends its time on, rendered in the Prometheus text format.
+
+Metrics are observed from the event loop as well as from the database threads, so every metric has its own lock.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Callable, Iterator, Mapping, Union
+
+import aiohttp
+
+# seconds, roughly exponential from 1ms to 1min
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, name: str, help_: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._values: dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            if (series := self._values.get(key)) is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def values(self) -> dict[Labels, tuple[list[int], float]]:
+        """Count per bucket (not cumulative) and sum of every series"""
+        with self._lock:
+            return {labels: (list(counts), sum_) for labels, (counts, sum_) in self._values.items()}
+
+    def quantile(self, q: float, counts: list[int]) -> float:
+        """Estimate a quantile from the bucket counts (the upper bound of the bucket it falls in)"""
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, sum_) in self.values().items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels((*labels, ("le", str(bound))))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(labels)} {sum_}'
+            yield f'{self.name}_count{_format_labels(labels)} {cumulative}'
+
+
+class Collected:
+    """Counter or gauge whose values are read from a callback when the metrics are rendered, for values that are
+    counted anyway (like the requests per host of the rate limiter)"""
+
+    def __init__(self, name: str, help_: str, type_: str, read: Callable[[], dict[Labels, float]]):
+        self.name = name
+        self.help = help_
+        self.type = type_
+        self.read = read
+
+    def values(self) -> dict[Labels, float]:
+        return self.read()
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, value in self.values().items():
+            yield f'{self.name}{_format_labels(labels)} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Union[Histogram, Collected]] = {}
+
+    def histogram(self, name: str, help_: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help_, buckets))
+
+    def collect(self, name: str, help_: str, read: Callable[[], Union[float, Mapping[str, float]]],
+                label: str = '', type_: str = 'gauge'):
+        """Register (or replace) a collected counter or gauge.
+        read() returns a single value, or a mapping from values of the given label to values."""
+        def values() -> dict[Labels, float]:
+            value = read()
+            if isinstance(value, Mapping):
+                return {((label, str(k)),): v for k, v in value.items()}
+            return {(): value}
+
+        self.metrics[name] = Collected(name, help_, type_, values)
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics.values() for line in metric.render()) + '\n'
+
+
+METRICS = Registry()
+
+COMMAND_SECONDS = METRICS.histogram('shinobu_command_seconds', 'Time taken by commands, by command and outcome')
+DB_SECONDS = METRICS.histogram('shinobu_db_seconds', 'Time taken by database calls, by kind and function')
+HTTP_SECONDS = METRICS.histogram('shinobu_http_request_seconds', 'Time taken by outgoing HTTP requests,'
+                                                                 ' by host and status')
+DISCORD_SECONDS = METRICS.histogram('shinobu_discord_request_seconds', 'Time taken by Discord REST requests,'
+                                                                       ' by method and route')
+
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    """Trace config for aiohttp sessions (trace_configs=[...]) which records their requests in HTTP_SECONDS"""
+    async def on_request_start(_, context: SimpleNamespace, __):
+        context.start = time.perf_counter()
+
+    async def on_request_end(_, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+        HTTP_SECONDS.observe(time.perf_counter() - context.start, host=params.url.host, status=params.response.status)
+
+    async def on_request_exception(_, context: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams):
+        HTTP_SECONDS.observe(time.perf_counter() - context.start, host=params.url.host, status='error')
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
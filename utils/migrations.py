@@ -0,0 +1,374 @@
+"""Versioned schema of the database.
+
+Migrations are applied in order and exactly once, the applied versions are recorded in schema_migration.
+Never edit a migration that has already been released, add a new one instead.
+
+Running this module migrates a database (an in-memory one by default) and checks that none of the hot queries
+does a full table scan or sorts in a temporary b-tree:
+    python -m utils.migrations [db_path]
+"""
+import logging
+import sqlite3
+import sys
+from typing import NamedTuple
+
+from utils.database import DB
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: list[str]
+
+
+# tables whose changes influence pack draws, see utils.waifus.catalog_version
+CATALOG_TABLES = ('character', 'rarity', 'pack', 'batch_in_pack')
+
+MIGRATIONS = [
+    Migration(1, 'initial schema', [
+        # IF NOT EXISTS: databases from before the migrations already have these tables
+        """
+        CREATE TABLE IF NOT EXISTS user(
+            id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0 CHECK (balance >= 0),
+            last_withdrawal TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            birthday TEXT,
+            mal_username TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rarity(
+            value INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            colour INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            refund INTEGER NOT NULL,
+            upgrade_cost INTEGER,
+            auto_upgrade BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS batch(
+            name TEXT PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS character(
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            image_url TEXT,
+            series TEXT NOT NULL,
+            rarity INTEGER NOT NULL REFERENCES rarity(value),
+            batch TEXT NOT NULL REFERENCES batch(name)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pack(
+            name TEXT PRIMARY KEY,
+            cost INTEGER NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            start_date TEXT NOT NULL,
+            end_date TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS batch_in_pack(
+            batch TEXT NOT NULL REFERENCES batch(name),
+            pack TEXT NOT NULL REFERENCES pack(name),
+            weight REAL NOT NULL DEFAULT 1,
+            PRIMARY KEY (pack, batch)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS waifu(
+            id INTEGER PRIMARY KEY,
+            user INTEGER NOT NULL REFERENCES user(id),
+            character INTEGER NOT NULL REFERENCES character(id),
+            rarity INTEGER NOT NULL REFERENCES rarity(value),
+            UNIQUE (user, character)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS consumed_media(
+            user INTEGER NOT NULL REFERENCES user(id),
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            PRIMARY KEY (user, type, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS voice_to_text(
+            voice_id INTEGER PRIMARY KEY,
+            text_id INTEGER NOT NULL
+        )
+        """,
+    ]),
+    Migration(2, 'catalog version', [
+        # replaces the unversioned catalog_version table that was installed on startup before
+        'DROP TABLE IF EXISTS catalog_version',
+        'CREATE TABLE catalog_version(id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)',
+        'INSERT INTO catalog_version(id, version) VALUES(0, 0)',
+        *(statement
+          for table in CATALOG_TABLES for event in ('INSERT', 'UPDATE', 'DELETE')
+          for statement in (
+              f'DROP TRIGGER IF EXISTS {table}_{event.lower()}_bumps_catalog_version',
+              f"""
+              CREATE TRIGGER {table}_{event.lower()}_bumps_catalog_version AFTER {event} ON {table}
+              BEGIN UPDATE catalog_version SET version=version+1 WHERE id=0; END
+              """)),
+    ]),
+    Migration(3, 'myanimelist caches', [
+        """
+        CREATE TABLE IF NOT EXISTS mal_metadata(
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            title TEXT,
+            thumbnail TEXT,
+            score REAL,
+            status TEXT,
+            duration INTEGER,
+            volumes INTEGER,
+            chapters INTEGER,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (type, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mal_search(
+            type TEXT NOT NULL,
+            query TEXT NOT NULL,
+            id INTEGER,  -- NULL if there were no results
+            searched_at REAL NOT NULL,
+            PRIMARY KEY (type, query)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mal_feed(
+            user INTEGER NOT NULL,
+            rss_type TEXT NOT NULL,
+            url TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            PRIMARY KEY (user, rss_type)
+        )
+        """,
+    ]),
+    Migration(4, 'hot path indexes', [
+        # find_waifus and the waifu search index (covering: waifu.id is the rowid)
+        'CREATE INDEX IF NOT EXISTS waifu_by_user ON waifu(user, character, rarity)',
+        # pick_character
+        'CREATE INDEX IF NOT EXISTS character_by_batch ON character(batch, rarity)',
+        # new_mal_content (covering)
+        'CREATE INDEX IF NOT EXISTS consumed_media_by_user ON consumed_media(user, type, id, amount)',
+        # Economy.birthday
+        'CREATE INDEX IF NOT EXISTS user_by_birthday ON user(birthday)',
+        # Economy.reward_media_consumption
+        'CREATE INDEX IF NOT EXISTS user_by_mal_username ON user(mal_username)',
+        # CURRENT_PREDICATE
+        'CREATE INDEX IF NOT EXISTS pack_by_dates ON pack(start_date, end_date)',
+    ]),
+    Migration(5, 'scheduled jobs', [
+        """
+        CREATE TABLE job(
+            name TEXT PRIMARY KEY,
+            interval REAL NOT NULL,  -- seconds
+            next_run REAL NOT NULL,  -- unix timestamp
+            last_run REAL
+        )
+        """,
+        """
+        CREATE TABLE idempotency_key(
+            key TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    Migration(6, 'pending trade changes', [
+        """
+        CREATE TABLE trade_change(
+            id INTEGER PRIMARY KEY,
+            owner INTEGER NOT NULL REFERENCES user(id),
+            from_id INTEGER NOT NULL REFERENCES user(id),
+            to_id INTEGER NOT NULL REFERENCES user(id),
+            amount INTEGER,
+            waifu INTEGER REFERENCES waifu(id),
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            CHECK ((amount IS NULL) != (waifu IS NULL))
+        )
+        """,
+        'CREATE INDEX trade_change_by_owner ON trade_change(owner)',
+    ]),
+    Migration(7, 'mal titles', [
+        """
+        CREATE TABLE mal_title(
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            PRIMARY KEY (type, id, title)
+        )
+        """,
+        # the alternative titles of the series scraped so far are only learned when they are scraped again
+        'INSERT INTO mal_title(type, id, title) SELECT type, id, title FROM mal_metadata WHERE title IS NOT NULL',
+    ]),
+    Migration(8, 'image checks', [
+        """
+        CREATE TABLE image_check(
+            url TEXT PRIMARY KEY,
+            status INTEGER,  -- NULL if the server couldn't be reached
+            content_type TEXT,
+            size INTEGER,
+            ok BOOLEAN NOT NULL,
+            checked_at REAL NOT NULL  -- unix timestamp
+        )
+        """,
+        # the samplers and indexes hold the image urls dropped for dead images, see utils.image_check
+        """
+        CREATE TRIGGER image_check_insert_bumps_catalog_version AFTER INSERT ON image_check WHEN NOT new.ok
+        BEGIN UPDATE catalog_version SET version=version+1 WHERE id=0; END
+        """,
+        """
+        CREATE TRIGGER image_check_update_bumps_catalog_version AFTER UPDATE OF ok ON image_check
+        WHEN old.ok IS NOT new.ok
+        BEGIN UPDATE catalog_version SET version=version+1 WHERE id=0; END
+        """,
+    ]),
+    Migration(9, 'waifu list order', [
+        # a copy of the character's name, so that the waifu list (see waifu_list_page) is read in index order
+        "ALTER TABLE waifu ADD COLUMN name TEXT NOT NULL DEFAULT ''",
+        'UPDATE waifu SET name=(SELECT character.name FROM character WHERE character.id = waifu.character)',
+        'CREATE INDEX waifu_list ON waifu(user, rarity DESC, name, id)',
+        # renaming a character renames its waifus
+        'CREATE INDEX waifu_by_character ON waifu(character)',
+        # kept in sync by triggers rather than by the writers, add_characters.py renames characters too
+        """
+        CREATE TRIGGER waifu_insert_copies_name AFTER INSERT ON waifu
+        BEGIN
+            UPDATE waifu SET name=(SELECT character.name FROM character WHERE character.id = new.character)
+            WHERE id=new.id;
+        END
+        """,
+        """
+        CREATE TRIGGER waifu_update_copies_name AFTER UPDATE OF character ON waifu
+        BEGIN
+            UPDATE waifu SET name=(SELECT character.name FROM character WHERE character.id = new.character)
+            WHERE id=new.id;
+        END
+        """,
+        """
+        CREATE TRIGGER character_rename_copies_name AFTER UPDATE OF name ON character WHEN old.name IS NOT new.name
+        BEGIN UPDATE waifu SET name=new.name WHERE character=new.id; END
+        """,
+    ]),
+    Migration(10, 'image version', [
+        # only the samplers hold live image urls (see utils.waifus.LIVE_IMAGE_URL), the search indexes don't depend on
+        # them: image checks bump a version of their own instead of the catalog version
+        'ALTER TABLE catalog_version ADD COLUMN image_version INTEGER NOT NULL DEFAULT 0',
+        'DROP TRIGGER image_check_insert_bumps_catalog_version',
+        'DROP TRIGGER image_check_update_bumps_catalog_version',
+        """
+        CREATE TRIGGER image_check_insert_bumps_image_version AFTER INSERT ON image_check WHEN NOT new.ok
+        BEGIN UPDATE catalog_version SET image_version=image_version+1 WHERE id=0; END
+        """,
+        """
+        CREATE TRIGGER image_check_update_bumps_image_version AFTER UPDATE OF ok ON image_check
+        WHEN old.ok IS NOT new.ok
+        BEGIN UPDATE catalog_version SET image_version=image_version+1 WHERE id=0; END
+        """,
+    ]),
+]
+
+
+def schema_version(db: DB) -> int:
+    db.execute('CREATE TABLE IF NOT EXISTS schema_migration('
+               ' version INTEGER PRIMARY KEY, name TEXT NOT NULL,'
+               ' applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)')
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migration').fetchone()[0]
+
+
+def migrate(db: DB):
+    """Apply all pending migrations, must be run inside a transaction (see Database.transaction)"""
+    version = schema_version(db)
+    if version > MIGRATIONS[-1].version:
+        raise RuntimeError(f'The database schema (version {version}) is newer than this version of the bot'
+                           f' (version {MIGRATIONS[-1].version})')
+
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(f'migrating the database to version {migration.version} ({migration.name})')
+        for statement in migration.statements:
+            db.execute(statement)
+        db.execute('INSERT INTO schema_migration(version, name) VALUES(?, ?)', [migration.version, migration.name])
+
+
+def hot_queries() -> dict[str, tuple[str, list]]:
+    """The queries run by commands and tasks (with dummy parameters), name -> (sql, parameters). Queries which load
+    whole tables on purpose (the pack samplers, the catalog search index, the MAL title index, voice_to_text) aren't
+    listed."""
+    # imported here, the modules running the queries import half of the bot
+    from extensions import economy
+    from utils import mal_cache, mal_rss, scheduler, trade, waifu_search, waifus
+    return {
+        'utils.waifus.buy_packs (user)': (waifus.USER_QUERY, [1]),
+        'utils.waifus.buy_packs (pack)': (waifus.CURRENT_PACK_QUERY, ['pack']),
+        'utils.waifus.catalog_version': (waifus.CATALOG_VERSION_QUERY, []),
+        'utils.waifus.SamplerCache': (waifus.SAMPLERS_VERSION_QUERY, []),
+        'utils.waifus.pick_character': (waifus.PACK_CHARACTERS_QUERY, ['pack', 1]),
+        'utils.waifus.give_waifu (waifu)': (waifus.OWNED_WAIFU_QUERY, [1, 1]),
+        'utils.waifus.give_waifu (rarity)': (waifus.RARITY_QUERY, [1]),
+        'utils.waifus.give_waifu (update)': (waifus.UPDATE_WAIFU_RARITY, [1, 1]),
+        'utils.waifus.waifu_list_page (first page)': (waifus.WAIFU_LIST_QUERY.format(keyset=''), [1, 21]),
+        'utils.waifus.waifu_list_page (same rarity)': (
+            waifus.WAIFU_LIST_QUERY.format(keyset=waifus.WAIFU_LIST_SAME_RARITY), [1, 2, 'name', 1, 21]),
+        'utils.waifus.waifu_list_page (lower rarities)': (
+            waifus.WAIFU_LIST_QUERY.format(keyset=waifus.WAIFU_LIST_LOWER_RARITIES), [1, 2, 21]),
+        'utils.waifus.find_waifus': (waifus.OWNED_WAIFU_BY_ID_QUERY, [1, 1]),
+        'utils.waifu_search.WaifuSearchIndex': (waifu_search.USER_WAIFUS_QUERY, [1]),
+        'utils.trade.has_pending_changes': (trade.HAS_PENDING_CHANGES_QUERY, [1]),
+        'utils.trade.pending_changes': (trade.PENDING_CHANGES_QUERY.format(owners='?, ?'), [1, 2]),
+        'utils.trade.add_money': (trade.ADD_MONEY, [1, 1]),
+        'extensions.economy.birthday': (economy.BIRTHDAY_USERS_QUERY, ['2000-01-01']),
+        'extensions.economy.reward_media_consumption': (economy.MAL_USERS_QUERY, []),
+        'utils.mal_rss.new_mal_content (feeds)': (mal_rss.FEEDS_QUERY, [1]),
+        'utils.mal_rss.new_mal_content (consumed)': (mal_rss.CONSUMED_QUERY, ['anime', 1]),
+        'utils.scheduler (job)': (scheduler.CLAIM_RUN, [1, 1, 'job', 0]),
+        'utils.scheduler.claim_idempotency_key': (scheduler.CLAIM_IDEMPOTENCY_KEY, ['key']),
+        'utils.mal_cache.MalMetadataCache': (mal_cache.METADATA_QUERY, ['anime', 1]),
+        'utils.mal_cache.MalSearchCache': (mal_cache.SEARCH_QUERY, ['anime', 'query']),
+    }
+
+
+def full_table_scans(db: DB, queries: dict[str, tuple[str, list]]) -> list[tuple[str, str]]:
+    """Get (query name, query plan step) pairs for every step of the queries that scans a whole table, or sorts
+    (or groups) its rows in a temporary b-tree rather than reading them in index order"""
+    scans = []
+    for name, (sql, parameters) in queries.items():
+        for *_, detail in db.execute(f'EXPLAIN QUERY PLAN {sql}', parameters):
+            if ((detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW')
+                    or detail.startswith('USE TEMP B-TREE')):
+                scans.append((name, detail))
+    return scans
+
+
+def main(db_path: str = ':memory:'):
+    logging.basicConfig(level=logging.INFO)
+    db = sqlite3.connect(db_path, isolation_level=None)
+    db.execute('BEGIN IMMEDIATE')
+    migrate(db)
+    db.execute('COMMIT')
+
+    queries = hot_queries()
+    if scans := full_table_scans(db, queries):
+        for name, detail in scans:
+            print(f'{name}: {detail}')
+        sys.exit(1)
+    print(f'schema version {schema_version(db)}, none of the {len(queries)} hot queries scans a whole table'
+          f' or sorts in a temporary b-tree')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
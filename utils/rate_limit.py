@@ -0,0 +1,38 @@
+import asyncio
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """Token buckets shared by every request to the same host, also counts the requests per host"""
+
+    def __init__(self, limits: dict[str, tuple[float, float]]):
+        self.buckets = {host: TokenBucket(rate, capacity) for host, (rate, capacity) in limits.items()}
+        self.requests: Counter[str] = Counter()
+
+    async def wait(self, url: str):
+        host = urlsplit(url).hostname
+        self.requests[host] += 1
+        if bucket := self.buckets.get(host):
+            await bucket.acquire()
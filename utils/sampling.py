@@ -0,0 +1,42 @@
+import random
+from typing import Generic, Sequence, TypeVar
+
+_T = TypeVar('_T')
+
+
+class AliasTable(Generic[_T]):
+    """Weighted sampler using Vose's alias method: O(n) to build, O(1) per draw."""
+
+    def __init__(self, items: Sequence[_T], weights: Sequence[float]):
+        if len(items) != len(weights):
+            raise ValueError('The number of weights does not match the population')
+        n = len(items)
+        total = sum(weights)
+        if n == 0 or total <= 0:
+            raise ValueError('Cannot sample from an empty population')
+
+        self.items = items
+        self.probabilities = [0.0] * n
+        self.aliases = [0] * n
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probabilities[s] = scaled[s]
+            self.aliases[s] = l
+            scaled[l] += scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+        # whatever is left over is (up to rounding errors) exactly full
+        for i in large + small:
+            self.probabilities[i] = 1.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def sample(self, rng: random.Random = random) -> _T:
+        i = int(rng.random() * len(self.items))
+        if rng.random() < self.probabilities[i]:
+            return self.items[i]
+        return self.items[self.aliases[i]]
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+from utils.database import DB, Database
+
+logger = logging.getLogger(__name__)
+
+CLAIM_IDEMPOTENCY_KEY = 'INSERT OR IGNORE INTO idempotency_key(key) VALUES(?)'
+CLAIM_RUN = 'UPDATE job SET next_run=?, last_run=? WHERE name=? AND next_run=?'
+
+
+class CatchUp(Enum):
+    """What to do with the runs of a job that were missed while the bot was offline"""
+    SKIP = 'skip'  # drop them, the job waits for its next slot
+    ONCE = 'once'  # coalesce them into a single run
+    ALL = 'all'  # run every one of them, oldest first
+
+
+@dataclass
+class Job:
+    name: str
+    # called with the time the run was scheduled for (not the time it actually runs at)
+    callback: Callable[[datetime], Awaitable]
+    interval: timedelta
+    catch_up: CatchUp
+
+
+def claim_idempotency_key(db: DB, key: str) -> bool:
+    """Record that the work identified by key has been done, return False if it already had been.
+    Claim the key in the same transaction as the work so that neither can happen without the other."""
+    return db.execute(CLAIM_IDEMPOTENCY_KEY, [key]).rowcount == 1
+
+
+def _load_job(db: DB, name: str, interval: float, first_run: float) -> float:
+    db.execute('INSERT OR IGNORE INTO job(name, interval, next_run) VALUES(?,?,?)', [name, interval, first_run])
+    db.execute('UPDATE job SET interval=? WHERE name=?', [interval, name])
+    return db.execute('SELECT next_run FROM job WHERE name=?', [name]).fetchone()[0]
+
+
+def _claim_run(db: DB, name: str, due: float, next_run: float) -> Optional[float]:
+    """Move the job to its next slot, return the slot it is at in the database if it was claimed by someone else"""
+    if db.execute(CLAIM_RUN, [next_run, time.time(), name, due]).rowcount == 1:
+        return None
+    return db.execute('SELECT next_run FROM job WHERE name=?', [name]).fetchone()[0]
+
+
+class Scheduler:
+    """Runs periodic jobs whose next run times are kept in the job table.
+
+    Restarts, reconnects and extension reloads don't reset the timers, so a job runs once per interval no matter
+    how often they happen. All jobs share a single wakeup: the loop sleeps until the earliest next run of a min-heap.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._jobs: dict[str, Job] = {}
+        # jobs registered since the loop last looked, their next run still has to be loaded
+        self._registered: set[str] = set()
+        self._next_run: dict[str, float] = {}
+        # (next run, job name), entries which don't match _next_run are outdated and skipped
+        self._heap: list[tuple[float, str]] = []
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, callback: Callable[[datetime], Awaitable], interval: timedelta,
+                 catch_up: CatchUp = CatchUp.ONCE):
+        """Schedule callback every interval, replacing the callback of a job with the same name.
+        The first run of a job that has never run before is right away."""
+        self._jobs[name] = Job(name, callback, interval, catch_up)
+        self._registered.add(name)
+        self._wakeup.set()
+
+    def unregister(self, name: str):
+        self._jobs.pop(name, None)
+        self._registered.discard(name)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _load_registered(self):
+        for name in list(self._registered):
+            job = self._jobs[name]
+            next_run = await self.db.transaction(_load_job, name, job.interval.total_seconds(), time.time())
+            self._registered.discard(name)
+            self._push(name, next_run)
+
+    def _push(self, name: str, next_run: float):
+        if self._next_run.get(name) != next_run:
+            self._next_run[name] = next_run
+            heapq.heappush(self._heap, (next_run, name))
+
+    async def _run(self):
+        while True:
+            # cleared first: a job registered while loading the others sets it again
+            self._wakeup.clear()
+            try:
+                await self._load_registered()
+            except Exception:
+                logger.exception('failed to load the scheduled jobs')
+                await asyncio.sleep(60)
+                continue
+
+            if self._heap and self._heap[0][0] <= time.time():
+                due, name = heapq.heappop(self._heap)
+                if self._next_run.get(name) != due:
+                    continue
+                if name not in self._jobs:
+                    # unregistered, registering it again will load its next run
+                    del self._next_run[name]
+                    continue
+                try:
+                    await self._dispatch(self._jobs[name], due)
+                except Exception:
+                    logger.exception(f'failed to schedule job {name}')
+                    heapq.heappush(self._heap, (due, name))
+                    await asyncio.sleep(60)
+                continue
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, job: Job, due: float):
+        interval = job.interval.total_seconds()
+        # whole intervals that have passed since the run was due
+        missed = int((time.time() - due) // interval)
+        if job.catch_up is CatchUp.ALL:
+            runs, next_run = [due], due + interval
+        elif job.catch_up is CatchUp.ONCE:
+            runs, next_run = [due + missed * interval], due + (missed + 1) * interval
+        else:
+            runs, next_run = [due] if not missed else [], due + (missed + 1) * interval
+
+        # claimed before running: a run that fails is not retried until the next slot
+        if (claimed_elsewhere := await self.db.transaction(_claim_run, job.name, due, next_run)) is not None:
+            self._push(job.name, claimed_elsewhere)
+            return
+        self._push(job.name, next_run)
+        for scheduled in runs:
+            asyncio.create_task(self._execute(job, scheduled))
+
+    async def _execute(self, job: Job, scheduled: float):
+        # runs of the same job never overlap
+        async with self._locks.setdefault(job.name, asyncio.Lock()):
+            logger.debug(f'running job {job.name} scheduled for {datetime.fromtimestamp(scheduled)}')
+            try:
+                await job.callback(datetime.fromtimestamp(scheduled))
+            except Exception:
+                logger.exception(f'job {job.name} failed')
@@ -1,24 +1,43 @@
 import asyncio
 import sqlite3
 from abc import abstractmethod
-from collections import UserList, defaultdict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from functools import partial, wraps
-from typing import Protocol, Final, Callable, Coroutine
-
-import nextcord
+from typing import Protocol, Final, Callable, Coroutine, Optional, Collection, Iterable, Awaitable
 
 from api.expected_errors import ExpectedCommandError
 from api.my_context import Context
 from data.CONSTANTS import CURRENCY
-from utils.database import DB, Waifu
+from utils.database import DB, Database, RowData, Waifu, on_commit, row_dataclass
+from utils.waifu_search import WAIFU_INDEX
 
 change_dataclass = partial(dataclass, frozen=True)
 
+ADD_MONEY = 'UPDATE user SET balance=balance+? WHERE id=?'
+HAS_PENDING_CHANGES_QUERY = 'SELECT 1 FROM trade_change WHERE owner=? LIMIT 1'
+# {owners} is a placeholder per owner id. The rows of each owner come in id order from the index, but not those of
+# several owners together: the few rows of a trade are sorted by pending_changes rather than in a temporary b-tree
+PENDING_CHANGES_QUERY = """
+SELECT trade_change.id, trade_change.owner, trade_change.from_id, trade_change.to_id, trade_change.amount,
+       waifu.id AS "waifu.id",
+       waifu.user AS "waifu.user.id",
+       character.id AS "waifu.character.id",
+       character.name AS "waifu.character.name",
+       character.series AS "waifu.character.series",
+       rarity.value AS "waifu.rarity.value",
+       rarity.name AS "waifu.rarity.name"
+FROM trade_change
+LEFT JOIN waifu ON waifu.id = trade_change.waifu
+LEFT JOIN character ON character.id = waifu.character
+LEFT JOIN rarity ON rarity.value = waifu.rarity
+WHERE trade_change.owner IN ({owners})
+"""
+
 
 def add_money(db: DB, user_id: int, amount: int):
     try:
-        db.execute('UPDATE user SET balance=balance+? WHERE id=?', [amount, user_id])
+        db.execute(ADD_MONEY, [amount, user_id])
     except sqlite3.IntegrityError:
         raise ExpectedCommandError(f'<@{user_id}> does not have enough {CURRENCY}!')
 
@@ -32,8 +51,14 @@ class Change(Protocol):
         if self.from_id == self.to_id:
             raise ExpectedCommandError("You can't give something to yourself!")
 
+    def check(self, db: DB):
+        """Raise an ExpectedCommandError if the change can't be queued"""
+
+    @abstractmethod
+    def execute(self, db: DB): ...
+
     @abstractmethod
-    async def execute(self, db: DB): ...
+    def columns(self) -> dict: ...
 
     @abstractmethod
     def __str__(self): ...
@@ -43,11 +68,22 @@ class Change(Protocol):
 class WaifuTransfer(Change):
     waifu: Waifu
 
-    async def execute(self, db: DB):
+    def check(self, db: DB):
+        self.waifu.ensure_ownership(db)
+
+    def execute(self, db: DB):
         try:
-            db.execute('UPDATE waifu SET user=? WHERE id=?', [self.to_id, self.waifu.id])
+            cursor = db.execute('UPDATE waifu SET user=? WHERE id=? AND user=?',
+                                [self.to_id, self.waifu.id, self.from_id])
         except sqlite3.IntegrityError:
             raise ExpectedCommandError("You can't give someone a waifu they already own!")
+        if cursor.rowcount == 0:
+            raise ExpectedCommandError(f"<@{self.from_id}> no longer owns {self.waifu.character.name}!")
+        on_commit(lambda: WAIFU_INDEX.remove(self.from_id, self.waifu.id))
+        on_commit(lambda: WAIFU_INDEX.add(self.to_id, self.waifu.id, self.waifu.character.name))
+
+    def columns(self) -> dict:
+        return {'waifu': self.waifu.id}
 
     def __str__(self):
         return (f"<@{self.from_id}> gives"
@@ -64,31 +100,137 @@ class MoneyTransfer(Change):
         if self.amount <= 0:
             raise ExpectedCommandError(f"You can only transfer positive amounts of {CURRENCY}!")
 
-    async def execute(self, db: DB):
-        with db:
-            add_money(db, self.from_id, -self.amount)
-            add_money(db, self.to_id, self.amount)
+    def execute(self, db: DB):
+        add_money(db, self.from_id, -self.amount)
+        add_money(db, self.to_id, self.amount)
+
+    def columns(self) -> dict:
+        return {'amount': self.amount}
 
     def __str__(self):
         return f"<@{self.from_id}> gives {self.amount} {CURRENCY} to <@{self.to_id}>"
 
 
-class LockedList(UserList):
-    def __init__(self, initlist=None):
-        # TODO: enforce locking
-        super().__init__(initlist)
-        self.lock = asyncio.Lock()
+@row_dataclass
+class TradeChange(RowData):
+    """A queued change, waiting in the trade_change table for its owner to sign it"""
+    id: int
+    owner: int
+    from_id: int
+    to_id: int
+    amount: Optional[int] = None
+    waifu: Optional[Waifu] = None
+
+    def change(self) -> Change:
+        if self.amount is not None:
+            return MoneyTransfer(from_id=self.from_id, to_id=self.to_id, amount=self.amount)
+        return WaifuTransfer(from_id=self.from_id, to_id=self.to_id, waifu=self.waifu)
+
+
+def queue_change(db: DB, owner_id: int, change: Change):
+    change.check(db)
+    columns = {'owner': owner_id, 'from_id': change.from_id, 'to_id': change.to_id, **change.columns()}
+    db.execute(f'INSERT INTO trade_change({", ".join(columns)}) VALUES({", ".join("?" * len(columns))})',
+               list(columns.values()))
+
+
+def has_pending_changes(db: DB, owner_id: int) -> bool:
+    return db.execute(HAS_PENDING_CHANGES_QUERY, [owner_id]).fetchone() is not None
+
+
+def pending_changes(db: DB, owner_ids: Collection[int]) -> list[TradeChange]:
+    changes = TradeChange.select_many(db, PENDING_CHANGES_QUERY.format(owners=", ".join("?" * len(owner_ids))),
+                                      list(owner_ids))
+    return sorted(changes, key=lambda c: c.id)
+
+
+def clear_changes(db: DB, owner_id: int) -> int:
+    return db.execute('DELETE FROM trade_change WHERE owner=?', [owner_id]).rowcount
+
+
+def execute_pending(db: DB, owner_ids: Collection[int], pending: list[TradeChange]):
+    """Execute the signed changes and remove them from the queues, all at once or not at all"""
+    if [c.id for c in pending_changes(db, owner_ids)] != [c.id for c in pending]:
+        # only possible if another process changed the queues
+        raise ExpectedCommandError("The transaction changed while it was being signed, please sign it again!")
+    for c in pending:
+        c.change().execute(db)
+    db.executemany('DELETE FROM trade_change WHERE id=?', [[c.id] for c in pending])
+
+
+class UserLocks:
+    """One lock per user, only kept while someone holds or waits for it"""
+
+    def __init__(self):
+        # user id -> [lock, number of holders and waiters]
+        self._locks: dict[int, list] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def __call__(self, user_ids: Iterable[int]):
+        """Lock all users at once. The locks are taken in the order of the user ids, so that two overlapping sets
+        of users can never wait for each other."""
+        entries = []
+        for user_id in sorted(set(user_ids)):
+            entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((user_id, entry))
+
+        acquired = []
+        try:
+            for _, (lock, _) in entries:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for user_id, entry in entries:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[user_id]
+
+
+class TradeEngine:
+    """Queues of changes every user builds up and then signs together with the other users involved.
+
+    The queues are kept in the trade_change table so they survive restarts, the in-process locks only make sure
+    a queue doesn't change while it is being signed.
+    """
+
+    def __init__(self):
+        self.locks = UserLocks()
+
+    async def queue(self, db: Database, owner_id: int, change: Change):
+        async with self.locks([owner_id]):
+            await db.transaction(queue_change, owner_id, change)
+
+    async def cancel(self, db: Database, owner_id: int) -> int:
+        async with self.locks([owner_id]):
+            return await db.transaction(clear_changes, owner_id)
+
+    async def sign(self, db: Database, owner_ids: Collection[int],
+                   confirm: Callable[[list[Change]], Awaitable[bool]]) -> Optional[list[Change]]:
+        """Execute the queued changes of all owners if confirm(changes) accepts them, None if it doesn't"""
+        async with self.locks(owner_ids):
+            pending = await db.read(pending_changes, owner_ids)
+            changes = [c.change() for c in pending]
+            if not await confirm(changes):
+                return None
+            await db.transaction(execute_pending, owner_ids, pending)
+            return changes
 
 
-CHANGES: Final[defaultdict[nextcord.User, LockedList]] = defaultdict(LockedList)
+TRADES: Final = TradeEngine()
 
 
 def forbid(func: Callable[..., Coroutine]):
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        # TODO: use the appropriate locks in this and in @require
         ctx = args[0] if isinstance(args[0], Context) else args[1]
-        if not CHANGES[ctx.author]:
+        if not await ctx.bot.db.read(has_pending_changes, ctx.author.id):
             await func(*args, **kwargs)
         else:
             raise ExpectedCommandError("You can't do this while you're in a transaction!")
@@ -100,7 +242,7 @@ def require(func: Callable[..., Coroutine]):
     @wraps(func)
     async def wrapper(*args, **kwargs):
         ctx = args[0] if isinstance(args[0], Context) else args[1]
-        if CHANGES[ctx.author]:
+        if await ctx.bot.db.read(has_pending_changes, ctx.author.id):
             await func(*args, **kwargs)
         else:
             raise ExpectedCommandError("You can only do this while you're in a transaction!")
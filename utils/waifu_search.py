@@ -0,0 +1,117 @@
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from fuzzywuzzy import fuzz
+
+from utils.database import DB
+
+# how many of the waifus sharing the most trigrams with a query are scored with the fuzzy matcher
+CANDIDATES = 32
+# how many users' indexes are kept, the least recently searched ones are dropped first
+MAX_INDEXES = 1000
+
+USER_WAIFUS_QUERY = 'SELECT waifu.id, character.name FROM waifu JOIN character ON character.id = waifu.character' \
+                    ' WHERE waifu.user = ?'
+
+
+def normalize(text: str) -> list[str]:
+    return re.findall(r'\w+', text.casefold())
+
+
+def trigrams(text: str) -> set[str]:
+    # every token is padded (like pg_trgm does) so that prefixes weigh more and short queries still have trigrams
+    grams = set()
+    for token in normalize(text):
+        padded = f'  {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class _UserIndex:
+    def __init__(self):
+        self.names: dict[int, str] = {}
+        self.postings: dict[str, set[int]] = {}
+
+    def add(self, waifu_id: int, name: str):
+        self.remove(waifu_id)
+        self.names[waifu_id] = name
+        for gram in trigrams(name):
+            self.postings.setdefault(gram, set()).add(waifu_id)
+
+    def remove(self, waifu_id: int):
+        if (name := self.names.pop(waifu_id, None)) is None:
+            return
+        for gram in trigrams(name):
+            posting = self.postings[gram]
+            posting.discard(waifu_id)
+            if not posting:
+                del self.postings[gram]
+
+    def search(self, query: str, limit: int) -> list[int]:
+        shared = Counter()
+        for gram in trigrams(query):
+            shared.update(self.postings.get(gram, ()))
+        # waifus sharing no trigram with the query aren't scored at all, that would be a scan of the whole collection
+        candidates = [i for i, _ in shared.most_common(max(limit, CANDIDATES))]
+        scored = sorted(((fuzz.token_set_ratio(query, self.names[i]), i) for i in candidates),
+                        key=lambda score_and_id: (-score_and_id[0], self.names[score_and_id[1]], score_and_id[1]))
+        return [i for _, i in scored[:limit]]
+
+
+class WaifuSearchIndex:
+    """Per-user trigram indexes of waifu names, built on first use and kept up to date by the code changing waifus.
+    Only the indexes of the max_indexes users who searched most recently are kept."""
+
+    def __init__(self, max_indexes: int = MAX_INDEXES):
+        self._lock = threading.Lock()
+        self.max_indexes = max_indexes
+        # least recently searched first
+        self._indexes: OrderedDict[int, _UserIndex] = OrderedDict()
+        # the catalog version the names in the indexes are from
+        self._catalog_version = None
+        # bumped on every change so that an index built from an outdated snapshot isn't kept
+        self._generations: Counter[int] = Counter()
+
+    def _index(self, db: DB, user_id: int, catalog_version: int) -> _UserIndex:
+        with self._lock:
+            if catalog_version != self._catalog_version:
+                # characters might have been renamed
+                self._indexes.clear()
+                self._catalog_version = catalog_version
+            if (index := self._indexes.get(user_id)) is not None:
+                self._indexes.move_to_end(user_id)
+                return index
+            generation = self._generations[user_id]
+
+        index = _UserIndex()
+        for waifu_id, name in db.execute(USER_WAIFUS_QUERY, [user_id]):
+            index.add(waifu_id, name)
+
+        with self._lock:
+            if self._generations[user_id] == generation:
+                self._indexes.setdefault(user_id, index)
+                while len(self._indexes) > self.max_indexes:
+                    self._indexes.popitem(last=False)
+        return index
+
+    def search(self, db: DB, user_id: int, query: str, catalog_version: int, limit: int = 10) -> list[int]:
+        """Get the ids of the user's waifus which best match the query, best match first"""
+        index = self._index(db, user_id, catalog_version)
+        with self._lock:
+            return index.search(query, limit)
+
+    def add(self, user_id: int, waifu_id: int, name: str):
+        with self._lock:
+            self._generations[user_id] += 1
+            if (index := self._indexes.get(user_id)) is not None:
+                index.add(waifu_id, name)
+
+    def remove(self, user_id: int, waifu_id: int):
+        with self._lock:
+            self._generations[user_id] += 1
+            if (index := self._indexes.get(user_id)) is not None:
+                index.remove(waifu_id)
+
+
+WAIFU_INDEX = WaifuSearchIndex()
@@ -1,15 +1,46 @@
-import random
+import sqlite3
+import threading
 from dataclasses import dataclass
-from typing import Union, Generator
-
-from fuzzywuzzy import process, fuzz
+from typing import Union, Generator, Hashable, Callable, Optional
 
 from api.expected_errors import ExpectedCommandError
-from utils.database import DB, Waifu, Pack, Character, User, Rarity
+from utils.database import DB, Database, Waifu, Pack, Character, User, Rarity, on_commit
+from utils.sampling import AliasTable
 from utils.trade import add_money
+from utils.waifu_search import WAIFU_INDEX
 
 CURRENT_PREDICATE = "((pack.start_date <= DATE('NOW', 'LOCALTIME')) " \
                     " AND (pack.end_date IS NULL OR pack.end_date >= DATE('NOW', 'LOCALTIME')))"
+# the image url of a character unless it is known to be dead (needs a LEFT JOIN of image_check, see utils.image_check)
+LIVE_IMAGE_URL = 'CASE WHEN image_check.ok = FALSE THEN NULL ELSE character.image_url END'
+
+# the queries run by the economy commands, their plans are checked by utils.migrations
+USER_QUERY = 'SELECT * FROM user WHERE id=?'
+CURRENT_PACK_QUERY = f'SELECT * FROM pack WHERE {CURRENT_PREDICATE} AND name LIKE ?'
+CATALOG_VERSION_QUERY = 'SELECT version FROM catalog_version WHERE id=0'
+SAMPLERS_VERSION_QUERY = 'SELECT version, image_version FROM catalog_version WHERE id=0'
+RARITY_QUERY = 'SELECT * FROM rarity WHERE value=?'
+# a character has a single batch, which is in the pack at most once: no character is joined more than once
+PACK_CHARACTERS_QUERY = f"""
+SELECT character.id,
+       character.name,
+       {LIVE_IMAGE_URL} AS image_url,
+       character.series,
+       character.rarity AS 'rarity.value',
+       character.batch AS 'batch.name',
+       batch_in_pack.weight AS __weight__
+FROM character
+JOIN batch_in_pack      ON batch_in_pack.batch = character.batch
+JOIN rarity             ON rarity.value >= character.rarity
+LEFT JOIN image_check   ON image_check.url = character.image_url
+WHERE batch_in_pack.pack = ? AND rarity.value = ?
+"""
+OWNED_WAIFU_QUERY = """
+SELECT waifu.id, waifu.rarity AS 'rarity.value',
+       waifu.character AS 'character.id', waifu.user AS 'user.id'
+FROM waifu WHERE user=? AND character=?
+"""
+UPDATE_WAIFU_RARITY = 'UPDATE waifu SET rarity=? WHERE id=?'
 
 
 @dataclass(frozen=True)
@@ -25,16 +56,26 @@ class Upgrade:
 DuplicateType = Union[Refund, Upgrade, None]
 
 
-async def buy_pack(db: DB, user_id: int, pack_name: str) -> tuple[Waifu, DuplicateType]:
-    with db:
-        user = User.select_one(db, 'SELECT * FROM user WHERE id=?', [user_id])
-        pack = Pack.select_one(db, f'SELECT * FROM pack WHERE {CURRENT_PREDICATE} AND name LIKE ?', [pack_name])
-        if pack is None:
-            raise ExpectedCommandError(f"There's no pack named {pack_name}!")
+MAX_PACKS_PER_PURCHASE = 50
+
+
+def buy_pack(db: DB, user_id: int, pack_name: str) -> tuple[Waifu, DuplicateType]:
+    return buy_packs(db, user_id, pack_name, 1)[0]
+
+
+def buy_packs(db: DB, user_id: int, pack_name: str, amount: int) -> list[tuple[Waifu, DuplicateType]]:
+    # must be run inside a transaction, see Database.transaction
+    if not 1 <= amount <= MAX_PACKS_PER_PURCHASE:
+        raise ExpectedCommandError(f"You can only buy between 1 and {MAX_PACKS_PER_PURCHASE} packs at once!")
 
-        add_money(db, user.id, -pack.cost)
-        character, rarity = pick_from_pack(db, pack.name)
-        return give_waifu(db, user, character, rarity)
+    user = User.select_one(db, USER_QUERY, [user_id])
+    pack = Pack.select_one(db, CURRENT_PACK_QUERY, [pack_name])
+    if pack is None:
+        raise ExpectedCommandError(f"There's no pack named {pack_name}!")
+
+    add_money(db, user.id, -pack.cost * amount)
+    # duplicates within the same purchase are resolved in order since give_waifu sees the previous draws
+    return [give_waifu(db, user, *pick_from_pack(db, pack.name)) for _ in range(amount)]
 
 
 def pick_from_pack(db: DB, pack_name: str) -> tuple[Character, Rarity]:
@@ -43,56 +84,83 @@ def pick_from_pack(db: DB, pack_name: str) -> tuple[Character, Rarity]:
     return character, rarity
 
 
-def pick(*args, **kwargs):
-    return random.choices(*args, **kwargs)[0]
+def catalog_version(db: DB) -> int:
+    # Every change to the tables that influence pack draws bumps the catalog version (this includes imports done by
+    # add_characters.py in another process, see utils.migrations), which invalidates the cached samplers and indexes.
+    return db.execute(CATALOG_VERSION_QUERY).fetchone()[0]
+
+
+def samplers_version(db: DB) -> tuple[int, int]:
+    # the character samplers also hold the image urls that are still alive, so images turning dead (or alive again)
+    # invalidate them as well, but not the search indexes (see utils.image_check)
+    return tuple(db.execute(SAMPLERS_VERSION_QUERY).fetchone())
+
+
+class SamplerCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._samplers: dict[Hashable, AliasTable] = {}
+
+    def get(self, db: DB, key: Hashable, build: Callable[[], AliasTable]) -> AliasTable:
+        version = samplers_version(db)
+        with self._lock:
+            if version != self._version:
+                self._samplers.clear()
+                self._version = version
+            sampler = self._samplers.get(key)
+        if sampler is None:
+            sampler = build()
+            with self._lock:
+                if version == self._version:
+                    self._samplers[key] = sampler
+        return sampler
+
+    def clear(self):
+        with self._lock:
+            self._samplers.clear()
+            self._version = None
+
+
+SAMPLERS = SamplerCache()
 
 
 def pick_rarity(db: DB) -> Rarity:
-    rarities = db.execute('SELECT * FROM rarity').fetchall()
-    return Rarity.build(**pick(rarities, weights=(r['weight'] for r in rarities)))
+    def build() -> AliasTable:
+        rarities = db.execute('SELECT * FROM rarity').fetchall()
+        return AliasTable(rarities, [r['weight'] for r in rarities])
+
+    return Rarity.build(**SAMPLERS.get(db, 'rarity', build).sample())
 
 
 def pick_character(db: DB, pack_name: str, rarity_val: int) -> Character:
-    chars = [dict(c) for c in db.execute("""
-    SELECT character.id,
-           character.name,
-           character.image_url,
-           character.series,
-           character.rarity AS 'rarity.value',
-           character.batch AS 'batch.name',
-           MAX(batch_in_pack.weight) AS __weight__
-    FROM character
-    JOIN batch_in_pack      ON batch_in_pack.batch = character.batch
-    JOIN rarity             ON rarity.value >= character.rarity
-    WHERE batch_in_pack.pack = ? AND rarity.value = ?
-    GROUP BY character.id
-    """, [pack_name, rarity_val])]
-    weights = [c.pop('__weight__') for c in chars]
-    return Character.build(**pick(chars, weights=weights))
+    def build() -> AliasTable:
+        chars = [dict(c) for c in db.execute(PACK_CHARACTERS_QUERY, [pack_name, rarity_val])]
+        weights = [c.pop('__weight__') for c in chars]
+        return AliasTable(chars, weights)
+
+    return Character.build(**SAMPLERS.get(db, ('character', pack_name, rarity_val), build).sample())
 
 
 def give_waifu(db: DB, user: User, character: Character, new_rarity: Rarity) -> tuple[Waifu, DuplicateType]:
-    waifu = Waifu.select_one(db, """
-    SELECT waifu.id, waifu.rarity AS 'rarity.value',
-           waifu.character AS 'character.id', waifu.user AS 'user.id'
-    FROM waifu WHERE user=? AND character=?
-    """, [user.id, character.id])
+    waifu = Waifu.select_one(db, OWNED_WAIFU_QUERY, [user.id, character.id])
 
     if waifu is None:
         waifu_id = db.execute('INSERT INTO waifu(user, character, rarity) VALUES(?, ?, ?)',
                               [user.id, character.id, new_rarity.value]).lastrowid
         waifu = Waifu(id=waifu_id, character=character, rarity=new_rarity, user=user)
         duplicate = None
+        on_commit(lambda: WAIFU_INDEX.add(user.id, waifu_id, character.name))
 
     elif waifu.rarity.value == new_rarity.value and new_rarity.auto_upgrade:
-        new_rarity = Rarity.select_one(db, 'SELECT * FROM rarity WHERE value=?', [waifu.rarity.value + 1])
-        db.execute('UPDATE waifu SET rarity=? WHERE id=?', [new_rarity.value, waifu.id])
+        new_rarity = Rarity.select_one(db, RARITY_QUERY, [waifu.rarity.value + 1])
+        db.execute(UPDATE_WAIFU_RARITY, [new_rarity.value, waifu.id])
         duplicate = Upgrade(new_rarity)
 
     else:
-        waifu.rarity = Rarity.select_one(db, 'SELECT * FROM rarity WHERE value=?', [waifu.rarity.value])
+        waifu.rarity = Rarity.select_one(db, RARITY_QUERY, [waifu.rarity.value])
         lower, higher = sorted((new_rarity, waifu.rarity), key=lambda r: r.value)
-        db.execute('UPDATE waifu SET rarity=? WHERE id=?', [higher.value, waifu.id])
+        db.execute(UPDATE_WAIFU_RARITY, [higher.value, waifu.id])
         duplicate = Refund(lower.refund)
         add_money(db, user.id, duplicate.amount)
 
@@ -107,32 +175,21 @@ def find_waifu(*args, **kwargs) -> Waifu:
     try:
         return next(find_waifus(*args, **kwargs))
     except StopIteration:
-        raise ExpectedCommandError("You don't have any waifus!")
-
+        raise ExpectedCommandError("You don't have any waifu matching that!")
 
-def find_waifus(db: DB, user_id: int, query: str) -> Generator[Waifu, None, None]:
-    waifus = list_waifus(db, user_id)
-    if not waifus:
-        raise StopIteration
 
-    matches = process.extract(query, (w.character.name for w in waifus), limit=None, scorer=fuzz.token_set_ratio)
-    for m in matches:
-        for i, w in enumerate(waifus):
-            if w.character.name == m[0]:
-                found_i = i
-                break
-        else:
-            continue
-        yield waifus.pop(found_i)
+def find_waifus(db: DB, user_id: int, query: str, limit: int = 10) -> Generator[Waifu, None, None]:
+    for waifu_id in WAIFU_INDEX.search(db, user_id, query, catalog_version(db), limit):
+        if waifu := Waifu.select_one(db, OWNED_WAIFU_BY_ID_QUERY, [waifu_id, user_id]):
+            yield waifu
 
 
-def list_waifus(db: DB, user_id: int) -> list[Waifu]:
-    return list(Waifu.select_many(db, """
+WAIFU_QUERY = f"""
     SELECT waifu.id,
            -- Character
                character.id AS "character.id",
                character.name AS "character.name",
-               character.image_url AS "character.image_url",
+               {LIVE_IMAGE_URL} AS "character.image_url",
                character.series AS "character.series",
            -- Rarity
                rarity.value AS "rarity.value",
@@ -151,7 +208,70 @@ def list_waifus(db: DB, user_id: int) -> list[Waifu]:
     JOIN character ON character.id = waifu.character
     JOIN rarity ON rarity.value = waifu.rarity
     JOIN user ON user.id = waifu.user
-    WHERE user.id = ?
-    ORDER BY rarity.value DESC,
-             character.name ASC
-    """, [user_id]))
+    LEFT JOIN image_check ON image_check.url = character.image_url
+"""
+OWNED_WAIFU_BY_ID_QUERY = f'{WAIFU_QUERY} WHERE waifu.id = ? AND user.id = ?'
+
+
+# (rarity value, character name, waifu id) of a waifu, the order of the waifu list without the descending rarity
+WaifuListKey = tuple[int, str, int]
+
+# the waifu list is read in the order of the waifu_list index (see utils.migrations), which has the character names
+WAIFU_LIST_QUERY = """
+SELECT waifu.id, waifu.name, rarity.value AS rarity_value, rarity.name AS rarity_name
+FROM waifu
+JOIN rarity ON rarity.value = waifu.rarity
+WHERE waifu.user = ? {keyset}
+ORDER BY waifu.rarity DESC,
+         waifu.name ASC,
+         waifu.id ASC
+LIMIT ?
+"""
+# the rest of the rarity of the last waifu, then the lower rarities: two index seeks, a single query with the whole
+# keyset in an OR would walk the index from the start of the list
+WAIFU_LIST_SAME_RARITY = 'AND waifu.rarity = ? AND (waifu.name, waifu.id) > (?, ?)'
+WAIFU_LIST_LOWER_RARITIES = 'AND waifu.rarity < ?'
+
+
+def waifu_list_page(db: DB, user_id: int, after: Optional[WaifuListKey], limit: int) -> list[sqlite3.Row]:
+    """Get (id, name, rarity value, rarity name) of the next waifus in the user's list after the given one.
+    The list is ordered by rarity (best first), then name, and is read with keyset pagination: a page never
+    costs more than its own rows, however far into the list it is."""
+    if after is None:
+        return db.execute(WAIFU_LIST_QUERY.format(keyset=''), [user_id, limit]).fetchall()
+    rarity, name, waifu_id = after
+    rows = db.execute(WAIFU_LIST_QUERY.format(keyset=WAIFU_LIST_SAME_RARITY),
+                      [user_id, rarity, name, waifu_id, limit]).fetchall()
+    if len(rows) < limit:
+        rows += db.execute(WAIFU_LIST_QUERY.format(keyset=WAIFU_LIST_LOWER_RARITIES),
+                           [user_id, rarity, limit - len(rows)]).fetchall()
+    return rows
+
+
+class WaifuListPages:
+    """Page provider (see Context.send_lazy_pager) of a user's waifu list which only fetches the viewed page"""
+
+    def __init__(self, db: Database, user_id: int, page_size: int = 20):
+        self.db = db
+        self.user_id = user_id
+        self.page_size = page_size
+        # key of the last waifu before every page reached so far
+        self._page_starts: list[Optional[WaifuListKey]] = [None]
+
+    async def __call__(self, number: int) -> tuple[str, bool]:
+        # pages are reached one after the other from the first, so the start of the requested one is known
+        rows = await self.db.read(waifu_list_page, self.user_id, self._page_starts[number], self.page_size + 1)
+        if not rows and number == 0:
+            raise ExpectedCommandError("You don't have any waifus!")
+        has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if has_next and len(self._page_starts) == number + 1:
+            last = rows[-1]
+            self._page_starts.append((last['rarity_value'], last['name'], last['id']))
+
+        if not rows:
+            # the waifus of this page were traded or sold since the previous page was shown
+            return '```md\nNo more waifus```', False
+        padding = max(len(row['name']) for row in rows)
+        lines = '\n'.join(f"{row['name']:<{padding}} - {row['rarity_name']}" for row in rows)
+        return f'```md\n{lines}```', has_next